@@ -4,94 +4,609 @@ import os
 import argparse
 import json
 import re
+import glob
 import random
 import platform
+import signal
+import sys
+import stat
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from functools import wraps
 from string import ascii_uppercase, ascii_lowercase, digits
 import subprocess
 from subprocess import CalledProcessError, check_output
-from os import path, listdir, chdir, fdopen, remove
-from urllib.request import urlopen, Request
-from shutil import rmtree, copy2, move
+from os import path, listdir, fdopen, remove
+import shutil
+from shutil import rmtree, copy2
 from tempfile import mkstemp, mkdtemp
-from time import sleep
+from time import sleep, time, monotonic, strftime, gmtime
 
 
 tmpdir = mkdtemp()
 print("Creating temp directory {} for installing CycleCloud".format(tmpdir))
-cycle_root = "/opt/cycle_server"
+# Everything the installer manages lives under sysroot (normally "/"), so a
+# whole install can be simulated against a scratch tree with fake tools on
+# PATH (see cyclecloud_install_bench.py)
+sysroot = os.environ.get("CYCLECLOUD_INSTALL_ROOT", "").rstrip("/")
+cycle_root = sysroot + "/opt/cycle_server"
+cs_user = os.environ.get("CYCLECLOUD_SERVICE_USER", "cycle_server")
+cyclecloud_cli = sysroot + "/usr/local/bin/cyclecloud"
+# Written by "cyclecloud initialize" for the user running the installer
+cli_config_file = path.expanduser("~/.cycle/cli.ini")
+apt_sources_dir = sysroot + "/etc/apt/sources.list.d"
+yum_repos_dir = sysroot + "/etc/yum.repos.d"
 cs_cmd = cycle_root + "/cycle_server"
+APT_LISTS_MAX_AGE = 3600
+OUTPUT_TAIL_LINES = 200
+DEFAULT_MAX_HEAP_SIZE = "4096M"
+AUTOTUNE_JVM_OPTIONS_PROPERTY = "webServerJvmOptions"
+AUTOTUNE_THREADS_PROPERTY = "webServerMaxThreads"
+# Seconds before a hung command is killed, by executable name (no entry: no limit)
+COMMAND_TIMEOUTS = {"apt": 1800, "apt-get": 1800, "yum": 1800, "dpkg-query": 120, "rpm": 300,
+                    "apt-key": 120, "wget": 600, "unzip": 600, "install.sh": 1800, "lsb_release": 60}
+DATASTORE_IMPORT_TIMEOUT = 120
+STARTUP_TIMEOUT = 900
+READINESS_PATH = "/"
+JOURNAL_FILE = cycle_root + "/install_journal.json"
+START_STATE_FILE = cycle_root + "/install_last_start.json"
+PROFILE_FILE = cycle_root + "/logs/install_profile.json"
+LETSENCRYPT_STATUS_FILE = cycle_root + "/install_letsencrypt_status.json"
+LETSENCRYPT_LOG_FILE = cycle_root + "/logs/install_letsencrypt.log"
+LETSENCRYPT_DEADLINE = 1800
+LETSENCRYPT_MAX_ATTEMPTS = 4
+WARMUP_STATUS_FILE = cycle_root + "/install_warmup_status.json"
+WARMUP_LOG_FILE = cycle_root + "/logs/install_warmup.log"
+# What the first users hit: the UI and the account/cluster APIs
+WARMUP_REQUESTS = ["/", "/cloud/accounts", "/cloud/clusters"]
+WARMUP_ROUNDS = 20
+WARMUP_CONCURRENCY = 8
+LOCK_FILE = sysroot + "/var/lock/cyclecloud_install.lock"
+IMDS_ENDPOINT = os.environ.get("CYCLECLOUD_IMDS_ENDPOINT", "http://169.254.169.254")
+IMDS_API_VERSION = "2017-08-01"
+IMDS_CACHE_FILE = sysroot + "/var/lib/cyclecloud_install/imds_instance.json"
+ARM_RESOURCE = "https://management.azure.com/"
+# Cached managed identity tokens are refreshed once they have less than this left
+IDENTITY_TOKEN_MIN_LIFETIME = 300
+# Seconds each caller waits for the identity to be assigned
+IDENTITY_TOKEN_DEADLINE = 300
+
+
+# Install profile: every phase and every command run through _catch_sys_error
+# is recorded as a span so slow deployments can be attributed to a phase.
+_profile_lock = threading.Lock()
+_profile_spans = []
+_span_context = threading.local()
 
 
 def clean_up():
     rmtree(tmpdir)
 
-def _catch_sys_error(cmd_list):
+def _redact_cmd(cmd_list):
+    redacted = []
+    for arg in cmd_list:
+        arg = str(arg)
+        if arg.startswith("--password="):
+            arg = "--password=********"
+        redacted.append(arg)
+    return redacted
+
+@contextmanager
+def span(name, kind="phase", **attrs):
+    stack = getattr(_span_context, "stack", None)
+    if stack is None:
+        stack = _span_context.stack = []
+    record = {"name": name,
+              "kind": kind,
+              "parent": stack[-1]["name"] if stack else None,
+              "thread": threading.current_thread().name,
+              "start": time(),
+              "duration": None,
+              "status": "ok",
+              "exit_status": None,
+              "retries": 0}
+    record.update(attrs)
+    stack.append(record)
+    started = monotonic()
     try:
-        output = check_output(cmd_list)
-        print(cmd_list)
-        print(output)
-        return output
-    except CalledProcessError as e:
-        print("Error with cmd: %s" % e.cmd)
-        print("Output: %s" % e.output)
+        yield record
+    except BaseException as e:
+        record["status"] = "error"
+        record["error"] = "%s: %s" % (type(e).__name__, e)
         raise
+    finally:
+        record["duration"] = monotonic() - started
+        record["end"] = record["start"] + record["duration"]
+        stack.pop()
+        with _profile_lock:
+            _profile_spans.append(record)
+
+def note_retry():
+    # Count a retry against the innermost open span of this thread
+    stack = getattr(_span_context, "stack", None)
+    if stack:
+        stack[-1]["retries"] += 1
+
+def timed_phase(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__, kind="phase"):
+            return func(*args, **kwargs)
+    return wrapper
+
+def _critical_path(phases):
+    # Walk back from the phase that finished last, each time picking the
+    # phase that finished last before the current one started: that is the
+    # predecessor which was actually blocking it.
+    if not phases:
+        return []
+    current = max(phases, key=lambda s: s["end"])
+    path = [current]
+    while True:
+        # Strictly earlier starts, so zero-length (skipped) phases can't form a cycle
+        blockers = [s for s in phases if s["end"] <= current["start"] + 0.001 and s["start"] < current["start"]]
+        if not blockers:
+            break
+        current = max(blockers, key=lambda s: s["end"])
+        path.append(current)
+    path.reverse()
+    return path
+
+def _atomic_write(file_path, content, mode=0o644):
+    directory = path.dirname(path.abspath(file_path))
+    if not path.isdir(directory):
+        os.makedirs(directory)
+    fh, tmp_path = mkstemp(dir=directory)
+    with fdopen(fh, 'w') as f:
+        f.write(content)
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, file_path)
+
+def _read_json_state(file_path):
+    # A state file written by _write_json_state, or {} if it is missing or unreadable
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+def _write_json_state(file_path, data, what):
+    # Failing to write a state file is reported, but does not fail the install
+    try:
+        _atomic_write(file_path, json.dumps(data, indent=2, sort_keys=True))
+    except (IOError, OSError) as e:
+        print("Unable to write %s: %s" % (what, e))
+
+def _prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def render_prometheus_profile(run_span, spans, managed_identity=None):
+    lines = []
+    def metric(name, help_text, samples):
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} gauge".format(name))
+        for labels, value in samples:
+            label_str = ",".join('{}="{}"'.format(k, _prometheus_label(v)) for k, v in labels)
+            lines.append("{}{{{}}} {}".format(name, label_str, value) if label_str else "{} {}".format(name, value))
+
+    phases = [s for s in spans if s["kind"] == "phase"]
+    commands = {}
+    for s in spans:
+        if s["kind"] != "command":
+            continue
+        totals = commands.setdefault(s["name"], [0, 0.0, 0, 0])
+        totals[0] += 1
+        totals[1] += s["duration"]
+        totals[2] += 1 if s["status"] != "ok" else 0
+        totals[3] += s.get("output_bytes") or 0
+
+    metric("cyclecloud_install_duration_seconds", "Wall time of the whole install run.",
+           [((), "%.3f" % run_span["duration"])])
+    metric("cyclecloud_install_success", "1 if the last install run succeeded.",
+           [((), 1 if run_span["status"] == "ok" else 0)])
+    metric("cyclecloud_install_last_run_timestamp_seconds", "Unix time the last install run finished.",
+           [((), "%.3f" % run_span["end"])])
+    metric("cyclecloud_install_phase_duration_seconds", "Wall time of each install phase.",
+           [((("phase", s["name"]), ("status", s["status"])), "%.3f" % s["duration"]) for s in phases])
+    metric("cyclecloud_install_phase_retries", "Retries performed inside each install phase.",
+           [((("phase", s["name"]),), s["retries"]) for s in phases])
+    if managed_identity:
+        metric("cyclecloud_install_managed_identity_available_seconds",
+               "Seconds from the start of the install until the managed identity token was obtained.",
+               [((), "%.3f" % managed_identity["available_after"])])
+    metric("cyclecloud_install_command_duration_seconds", "Total wall time spent in each external command.",
+           [((("command", name),), "%.3f" % t[1]) for name, t in sorted(commands.items())])
+    metric("cyclecloud_install_command_runs", "Number of invocations of each external command.",
+           [((("command", name),), t[0]) for name, t in sorted(commands.items())])
+    metric("cyclecloud_install_command_output_bytes", "Total output produced by each external command.",
+           [((("command", name),), t[3]) for name, t in sorted(commands.items())])
+    metric("cyclecloud_install_command_failures", "Number of failed invocations of each external command.",
+           [((("command", name),), t[2]) for name, t in sorted(commands.items())])
+    return "\n".join(lines) + "\n"
+
+def print_profile_summary(run_span, spans, managed_identity=None):
+    phases = sorted([s for s in spans if s["kind"] == "phase"], key=lambda s: s["start"])
+    critical = set(id(s) for s in _critical_path(phases))
+    print("")
+    print("Install profile (total %.1fs, status %s)" % (run_span["duration"], run_span["status"]))
+    print("%-2s %-28s %10s %10s %8s %8s %s" % ("", "phase", "start(s)", "duration", "retries", "cmds", "status"))
+    for s in phases:
+        n_cmds = len([c for c in spans if c["kind"] == "command" and c.get("phase") == s["name"]])
+        print("%-2s %-28s %10.1f %10.1f %8d %8d %s" % ("*" if id(s) in critical else "", s["name"],
+                                                       s["start"] - run_span["start"], s["duration"],
+                                                       s["retries"], n_cmds, s["status"]))
+    print("(* = critical path)")
+    if managed_identity:
+        print("Managed identity available after %.1fs" % managed_identity["available_after"])
+
+def write_install_profile(run_span, json_file, prometheus_file, show_summary=False):
+    with _profile_lock:
+        spans = list(_profile_spans)
+    managed_identity = None
+    if _identity_report:
+        managed_identity = dict(_identity_report, available_after=_identity_report["available_at"] - run_span["start"])
+    profile = {"run": run_span,
+               "phases": [s for s in spans if s["kind"] == "phase"],
+               "critical_path": [s["name"] for s in _critical_path([s for s in spans if s["kind"] == "phase"])],
+               "managed_identity": managed_identity,
+               "spans": spans}
+    try:
+        if json_file:
+            _atomic_write(json_file, json.dumps(profile, indent=2, default=str))
+            print("Wrote install profile to {}".format(json_file))
+        if prometheus_file:
+            _atomic_write(prometheus_file, render_prometheus_profile(run_span, spans, managed_identity))
+            print("Wrote Prometheus install metrics to {}".format(prometheus_file))
+    except (IOError, OSError) as e:
+        print("Unable to write install profile: %s" % e)
+    if show_summary:
+        print_profile_summary(run_span, spans, managed_identity)
+
+def _current_phase():
+    stack = getattr(_span_context, "stack", None) or []
+    for record in reversed(stack):
+        if record["kind"] == "phase":
+            return record["name"]
+    return None
+
+def _log_timestamp():
+    now = time()
+    return "{}.{:03d}Z".format(strftime("%Y-%m-%dT%H:%M:%S", gmtime(now)), int(now * 1000) % 1000)
+
+def _catch_sys_error(cmd_list, cwd=None, timeout=None, stdin_data=None):
+    # Run a command, streaming its stdout/stderr into the log line by line as
+    # it runs.  Only the last OUTPUT_TAIL_LINES lines are kept in memory: they
+    # are shown when the command fails, and the stdout lines among them are
+    # returned.  Commands are killed (with their children) after timeout
+    # seconds, by default the COMMAND_TIMEOUTS entry for the executable.
+    redacted = _redact_cmd(cmd_list)
+    label = path.basename(redacted[0])
+    if timeout is None:
+        timeout = COMMAND_TIMEOUTS.get(label)
+    with span(" ".join(redacted[:2]), kind="command", cmd=redacted, phase=_current_phase()) as record:
+        print(redacted)
+        tail = deque(maxlen=OUTPUT_TAIL_LINES)
+        stats = {"output_bytes": 0, "output_lines": 0, "buffer_peak_bytes": 0, "buffered": 0}
+        output_lock = threading.Lock()
+
+        def pump(stream, stream_name):
+            for raw in iter(stream.readline, b""):
+                with output_lock:
+                    if len(tail) == tail.maxlen:
+                        stats["buffered"] -= len(tail[0][1])
+                    tail.append((stream_name, raw))
+                    stats["buffered"] += len(raw)
+                    stats["output_bytes"] += len(raw)
+                    stats["output_lines"] += 1
+                    stats["buffer_peak_bytes"] = max(stats["buffer_peak_bytes"], stats["buffered"])
+                    print("{} {}[{}] {}".format(_log_timestamp(), label, stream_name,
+                                                raw.rstrip(b"\n").decode("utf-8", "replace")))
+            stream.close()
+
+        # A session of its own, so a timeout can kill everything the command spawned (e.g. dpkg under apt)
+        proc = subprocess.Popen(cmd_list, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                stdin=subprocess.PIPE if stdin_data is not None else None,
+                                start_new_session=True)
+        if stdin_data is not None:
+            try:
+                proc.stdin.write(stdin_data)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        readers = [threading.Thread(target=pump, args=(proc.stdout, "stdout")),
+                   threading.Thread(target=pump, args=(proc.stderr, "stderr"))]
+        for reader in readers:
+            reader.start()
+        timed_out = False
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+        for reader in readers:
+            reader.join()
+
+        record["exit_status"] = proc.returncode
+        record["output_bytes"] = stats["output_bytes"]
+        record["output_lines"] = stats["output_lines"]
+        record["buffer_peak_bytes"] = stats["buffer_peak_bytes"]
+        output = b"".join(raw for stream_name, raw in tail if stream_name == "stdout")
+        if timed_out or proc.returncode != 0:
+            if timed_out:
+                print("Timed out after %ss: %s" % (timeout, redacted))
+            print("Error with cmd: %s" % redacted)
+            print("Output (last %d of %d lines):" % (len(tail), stats["output_lines"]))
+            for stream_name, raw in tail:
+                print("    [%s] %s" % (stream_name, raw.rstrip(b"\n").decode("utf-8", "replace")))
+            if timed_out:
+                raise subprocess.TimeoutExpired(cmd_list, timeout, output=output)
+            raise CalledProcessError(proc.returncode, cmd_list, output=output)
+        return output
 
-def create_user(username):
+def create_user(username, home=None):
+    # Returns the user's home directory
     import pwd
     try:
-        pwd.getpwnam(username)
+        home = pwd.getpwnam(username).pw_dir
     except KeyError:
+        home = home or "/home/{}".format(username)
         print('Creating user {}'.format(username))
-        _catch_sys_error(["useradd", "-m", "-d", "/home/{}".format(username), username])
-    _catch_sys_error(["chown", "-R", username + ":" + username, "/home/{}".format(username)])
-
-def create_keypair(username, public_key=None):
-    if not os.path.isdir("/home/{}/.ssh".format(username)):
-        _catch_sys_error(["mkdir", "-p", "/home/{}/.ssh".format(username)])
-    public_key_file  = "/home/{}/.ssh/id_rsa.pub".format(username)
+        _catch_sys_error(["useradd", "-m", "-d", home, username])
+    fix_ownership([home], username, username)
+    return home
+
+def _key_material(line):
+    # The "type base64" part of an authorized_keys line, ignoring options and comment
+    fields = line.split()
+    for i, field in enumerate(fields[:-1]):
+        if field.startswith("ssh-") or field.startswith("ecdsa-") or field.startswith("sk-"):
+            return (field, fields[i + 1])
+    return None
+
+def add_authorized_keys(authorized_key_file, public_keys):
+    # Append the keys that aren't already authorized (compared by key material,
+    # so a changed comment doesn't duplicate a key).  Returns the number added.
+    lines = []
+    if path.exists(authorized_key_file):
+        with open(authorized_key_file) as authkeyfile:
+            lines = authkeyfile.read().splitlines()
+    present = set(_key_material(line) for line in lines)
+    added = 0
+    for public_key in public_keys:
+        public_key = public_key.strip()
+        material = _key_material(public_key)
+        if not public_key or (material or public_key) in present or public_key in lines:
+            continue
+        lines.append(public_key)
+        present.add(material or public_key)
+        added += 1
+    if added:
+        _atomic_write(authorized_key_file, "\n".join(lines) + "\n", mode=0o600)
+    return added
+
+def create_keypair(username, public_key=None, home=None):
+    ssh_dir = path.join(home or "/home/{}".format(username), ".ssh")
+    if not os.path.isdir(ssh_dir):
+        os.makedirs(ssh_dir, 0o700)
+    public_key_file = path.join(ssh_dir, "id_rsa.pub")
     if not os.path.exists(public_key_file):
         if public_key:
             with open(public_key_file, 'w') as pubkeyfile:
                 pubkeyfile.write(public_key)
                 pubkeyfile.write("\n")
         else:
-            _catch_sys_error(["ssh-keygen", "-f", "/home/{}/.ssh/id_rsa".format(username), "-N", ""])
+            _catch_sys_error(["ssh-keygen", "-q", "-f", path.join(ssh_dir, "id_rsa"), "-N", ""])
             with open(public_key_file, 'r') as pubkeyfile:
                 public_key = pubkeyfile.read()
-
-    authorized_key_file = "/home/{}/.ssh/authorized_keys".format(username)
-    authorized_keys = ""
-    if os.path.exists(authorized_key_file):
-        with open(authorized_key_file, 'r') as authkeyfile:
-            authorized_keys = authkeyfile.read()
-    if public_key not in authorized_keys:
-        with open(authorized_key_file, 'w') as authkeyfile:
-            authkeyfile.write(public_key)
-            authkeyfile.write("\n")
-    _catch_sys_error(["chown", "-R", username + ":" + username, "/home/{}".format(username)])
+    elif not public_key:
+        with open(public_key_file, 'r') as pubkeyfile:
+            public_key = pubkeyfile.read()
+    public_key = public_key.strip()
+
+    add_authorized_keys(path.join(ssh_dir, "authorized_keys"), [public_key])
+    fix_ownership([ssh_dir] + [path.join(ssh_dir, f) for f in ("id_rsa", "id_rsa.pub", "authorized_keys")],
+                  username, username)
     return public_key
 
+def _owner_ids(user, group=None):
+    import grp
+    import pwd
+    pw = pwd.getpwnam(user)
+    if group is None:
+        return pw.pw_uid, pw.pw_gid
+    try:
+        return pw.pw_uid, grp.getgrnam(group).gr_gid
+    except KeyError:
+        return pw.pw_uid, pw.pw_gid
+
+def fix_ownership(paths, user, group=None, recursive=False, exclude=(), workers=8):
+    # Give paths (and, if recursive, everything below them) to user:group.
+    # Unlike "chown -R" this only changes inodes that are actually owned by
+    # someone else (checked with lstat, never following symlinks), and large
+    # trees are scanned one directory per task on a thread pool.  Paths in
+    # exclude are skipped along with everything below them.  Returns
+    # (inodes changed, inodes checked).
+    uid, gid = _owner_ids(user, group)
+    exclude = set(path.abspath(e) for e in exclude)
+    counts = {"changed": 0, "checked": 0}
+    counts_lock = threading.Lock()
+
+    def fix(entry_path, st):
+        if st.st_uid == uid and st.st_gid == gid:
+            return 0
+        os.lchown(entry_path, uid, gid)
+        return 1
+
+    def scan_dir(directory):
+        changed = checked = 0
+        subdirs = []
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            return []
+        for entry in entries:
+            if entry.path in exclude:
+                continue
+            try:
+                checked += 1
+                changed += fix(entry.path, entry.stat(follow_symlinks=False))
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+            except FileNotFoundError:
+                continue
+        with counts_lock:
+            counts["changed"] += changed
+            counts["checked"] += checked
+        return subdirs
+
+    with span("fix_ownership", kind="wait", paths=list(paths), recursive=recursive) as record:
+        directories = []
+        for root in paths:
+            root = path.abspath(root)
+            if not path.lexists(root) or root in exclude:
+                continue
+            counts["checked"] += 1
+            counts["changed"] += fix(root, os.lstat(root))
+            if recursive and path.isdir(root) and not path.islink(root):
+                directories.append(root)
+
+        if directories:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chown") as pool:
+                pending = set(pool.submit(scan_dir, d) for d in directories)
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        pending.update(pool.submit(scan_dir, d) for d in future.result())
+        record.update(counts)
+    print("Fixed ownership of {} of {} inodes under {}".format(counts["changed"], counts["checked"], ", ".join(paths)))
+    return counts["changed"], counts["checked"]
+
 def create_user_credential(username, public_key=None):
-    create_user(username)    
-    public_key = create_keypair(username, public_key)
-
-    credential_record = {
-        "PublicKey": public_key,
-        "AdType": "Credential",
-        "CredentialType": "PublicKey",
-        "Name": username + "/public"
-    }
-    credential_data_file = os.path.join(tmpdir, "credential.json")
+    return provision_users([{"name": username, "publicKey": public_key}])
+
+def load_users_manifest(manifest_file):
+    # The manifest is a JSON list of users (or {"users": [...]}), each with a
+    # "name" and optionally a "publicKey" (a key pair is generated without one)
+    # and a "home" directory for users that don't exist yet.
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, dict):
+        manifest = manifest.get("users", [])
+
+    users = []
+    for entry in manifest:
+        name = entry.get("name") or ""
+        if not re.match(r"^[a-z_][a-z0-9_-]{0,31}$", name):
+            raise Exception("Invalid user name in users manifest: %r" % name)
+        users.append({"name": name, "publicKey": entry.get("publicKey"), "home": entry.get("home")})
+    names = [u["name"] for u in users]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise Exception("Duplicate user names in users manifest: %s" % ", ".join(duplicates))
+    return users
+
+@timed_phase
+def provision_users(users, concurrency=8):
+    # useradd serializes on the passwd lock, so users are created one at a time.
+    # Key setup (dominated by ssh-keygen) then runs concurrently, and all the
+    # PublicKey credentials go to the datastore in a single record file.
+    homes = dict((user["name"], create_user(user["name"], user.get("home"))) for user in users)
+
+    def credential(user):
+        public_key = create_keypair(user["name"], user.get("publicKey"), homes[user["name"]])
+        return {"PublicKey": public_key,
+                "AdType": "Credential",
+                "CredentialType": "PublicKey",
+                "Name": user["name"] + "/public"}
+
+    print("Setting up SSH keys for {} users ({} at a time)".format(len(users), concurrency))
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="user") as pool:
+        credential_records = list(pool.map(credential, users))
+
+    # Unique per call, so repeated provisioning never reuses a pending file name
+    fh, credential_data_file = mkstemp(dir=tmpdir, prefix="credentials_", suffix=".json")
     print("Creating cred file: {}".format(credential_data_file))
-    with open(credential_data_file, 'w') as fp:
-        json.dump(credential_record, fp)
+    with fdopen(fh, 'w') as fp:
+        json.dump(credential_records, fp)
 
+    dropped = drop_datastore_records(credential_data_file)
+    latencies = await_datastore_import(dropped)
+    return {"users": [user["name"] for user in users],
+            "imported": all(latency is not None for latency in latencies.values())}
+
+def drop_datastore_records(record_file):
+    # Hand a record file to CycleServer's datastore importer.  Returns the
+    # dropped file name with its drop time, for await_datastore_import().
     config_path = os.path.join(cycle_root, "config/data/")
     print("Copying config to {}".format(config_path))
-    _catch_sys_error(["chown", "cycle_server:cycle_server", credential_data_file])
+    fix_ownership([record_file], cs_user, cs_user)
     # Don't use copy2 here since ownership matters
-    # copy2(credential_data_file, config_path)
-    _catch_sys_error(["mv", credential_data_file, config_path])
+    # copy2(record_file, config_path)
+    _catch_sys_error(["mv", record_file, config_path])
+    return {path.basename(record_file): monotonic()}
+
+def _inotify_fd(directory):
+    # Returns a non-blocking inotify descriptor watching directory for entries
+    # being renamed or removed, or None where inotify is not available.
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        in_moved_from, in_delete = 0x40, 0x200
+        if libc.inotify_add_watch(fd, directory.encode("utf-8"), in_moved_from | in_delete) < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (OSError, AttributeError):
+        return None
+
+def await_datastore_import(dropped, timeout=DATASTORE_IMPORT_TIMEOUT):
+    # Block until CycleServer has consumed (renamed to *.imported) each of the
+    # dropped record files, or until the deadline passes.  Returns the import
+    # latency of each file in seconds, None for files not imported in time.
+    import select
+    data_dir = os.path.join(cycle_root, "config/data")
+    pending = dict(dropped)
+    latencies = {}
+    deadline = monotonic() + timeout
+    with span("await_datastore_import", kind="wait", files=sorted(pending)) as record:
+        fd = _inotify_fd(data_dir)
+        record["method"] = "inotify" if fd is not None else "poll"
+        poll_interval = 0.05
+        try:
+            while pending:
+                for name in list(pending):
+                    if not path.exists(path.join(data_dir, name)):
+                        latencies[name] = monotonic() - pending.pop(name)
+                        print("Datastore imported {} after {:.2f}s".format(name, latencies[name]))
+                remaining = deadline - monotonic()
+                if not pending or remaining <= 0:
+                    break
+                if fd is not None:
+                    # Wake on any rename/delete in the directory, re-check every second regardless
+                    if select.select([fd], [], [], min(remaining, 1.0))[0]:
+                        try:
+                            while os.read(fd, 4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                else:
+                    sleep(min(poll_interval, remaining))
+                    poll_interval = min(poll_interval * 2, 1.0)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        for name in pending:
+            print("WARNING: {} was not imported into the datastore after {}s".format(name, timeout))
+            latencies[name] = None
+        record["latencies"] = latencies
+    return latencies
 
 def generate_password_string():
     random_pw_chars = ([random.choice(ascii_lowercase) for _ in range(20)] +
@@ -117,10 +632,17 @@ def reset_cyclecloud_pw(username):
     _catch_sys_error([cs_cmd, 'execute', update_cmd])
     return pw 
 
+
+# The admin password account setup used in this run, by user.  Kept in memory
+# only: step results are written to the journal.
+_admin_passwords = {}
+
   
+@timed_phase
 def cyclecloud_account_setup(vm_metadata, use_managed_identity, tenant_id, application_id, application_secret,
                              admin_user, azure_cloud, accept_terms, password, storageAccount, no_default_account, 
-                             webserver_port):
+                             webserver_port, initialize_cli=True, extra_accounts=(), account_concurrency=4,
+                             imds=None, reset_password=False):
 
     print("Setting up azure account in CycleCloud and initializing cyclecloud CLI")
 
@@ -140,11 +662,19 @@ def cyclecloud_account_setup(vm_metadata, use_managed_identity, tenant_id, appli
         ascii_lowercase) for _ in range(14))
 
     cyclecloud_admin_pw = ""
+    reuse_credentials = False
     if password:
         print('Password specified, using it as the admin password')
         cyclecloud_admin_pw = password
     else:
-        cyclecloud_admin_pw = generate_password_string()
+        stored_pw = None if reset_password else stored_cli_password(admin_user, webserver_port)
+        if stored_pw and cyclecloud_credentials_valid(admin_user, stored_pw, webserver_port):
+            # A restart of an installed server: keep the password the CLI was initialized with
+            print("Stored CLI credentials for {} are valid, skipping the password reset".format(admin_user))
+            cyclecloud_admin_pw = stored_pw
+            reuse_credentials = True
+        else:
+            cyclecloud_admin_pw = generate_password_string()
 
     if storageAccount:
         print('Storage account specified, using it as the default locker')
@@ -152,22 +682,9 @@ def cyclecloud_account_setup(vm_metadata, use_managed_identity, tenant_id, appli
     else:
         storage_account_name = 'cyclecloud{}'.format(random_suffix)
 
-    azure_data = {
-        "Environment": azure_cloud,
-        "AzureRMUseManagedIdentity": use_managed_identity,
-        "AzureResourceGroup": resource_group,
-        "AzureRMApplicationId": application_id,
-        "AzureRMApplicationSecret": application_secret,
-        "AzureRMSubscriptionId": subscription_id,
-        "AzureRMTenantId": tenant_id,
-        "DefaultAccount": True,
-        "Location": location,
-        "Name": "azure",
-        "Provider": "azure",
-        "ProviderId": subscription_id,
-        "RMStorageAccount": storage_account_name,
-        "RMStorageContainer": "cyclecloud"
-    }
+    azure_data = azure_account_data("azure", subscription_id, tenant_id, application_id, application_secret,
+                                     use_managed_identity, azure_cloud, location, resource_group,
+                                     storage_account_name, default_account=True)
     distribution_method ={
         "Category": "system",
         "Status": "internal",
@@ -176,9 +693,6 @@ def cyclecloud_account_setup(vm_metadata, use_managed_identity, tenant_id, appli
         "Value": "manual",
         "Name": "distribution_method"
     }
-    if use_managed_identity:
-        azure_data["AzureRMUseManagedIdentity"] = True
-
     app_setting_installation = {
         "AdType": "Application.Setting",
         "Name": "cycleserver.installation.complete",
@@ -205,17 +719,18 @@ def cyclecloud_account_setup(vm_metadata, use_managed_identity, tenant_id, appli
         }
         account_data.append(login_user)
 
-    account_data_file = tmpdir + "/account_data.json"
+    if reuse_credentials and accept_terms:
+        # The admin user can log in, so these records were imported on an earlier run
+        print("Admin user {} already set up, not importing the account records again".format(admin_user))
+    else:
+        account_data_file = tmpdir + "/account_data.json"
 
-    with open(account_data_file, 'w') as fp:
-        json.dump(account_data, fp)
+        with open(account_data_file, 'w') as fp:
+            json.dump(account_data, fp)
 
-    config_path = os.path.join(cycle_root, "config/data/")
-    _catch_sys_error(["chown", "cycle_server:cycle_server", account_data_file])
-    # Don't use copy2 here since ownership matters
-    # copy2(account_data_file, config_path)
-    _catch_sys_error(["mv", account_data_file, config_path])
-    sleep(5)
+        dropped = drop_datastore_records(account_data_file)
+        # reset_access and the CLI need the admin user, so wait until it has been imported
+        await_datastore_import(dropped)
 
     if not accept_terms:
         # reset the installation status so the splash screen re-appears
@@ -224,35 +739,374 @@ def cyclecloud_account_setup(vm_metadata, use_managed_identity, tenant_id, appli
         _catch_sys_error(
             ["/opt/cycle_server/cycle_server", "execute", sql_statement])
 
-    # If using a random password, we need to reset it on each container restart (since we regenerated it above)
+    # If using a random password, we need to reset it on each container restart where the stored
+    # CLI credentials no longer work (since we regenerated it above)
     # But do is AFTER user is created in CC
-    if not password:
+    if not password and not reuse_credentials:
         cyclecloud_admin_pw = reset_cyclecloud_pw(admin_user)
-    initialize_cyclecloud_cli(admin_user, cyclecloud_admin_pw, webserver_port)
+    _admin_passwords[admin_user] = cyclecloud_admin_pw
 
+    # The CLI configuration the credentials came from is already initialized
+    cli_initialized = reuse_credentials
     if no_default_account:
         print("Skipping default account creation (--noDefaultAccount).") 
     else:
-        output =  _catch_sys_error(["/usr/local/bin/cyclecloud", "account", "show", "azure"])
-        if 'Credentials: azure' in str(output):
-            print("Account \"azure\" already exists.   Skipping account setup...")
-        else:
-            azure_data_file = tmpdir + "/azure_data.json"
-            with open(azure_data_file, 'w') as fp:
-                json.dump(azure_data, fp)
+        client = CycleCloudClient("localhost", webserver_port, admin_user, cyclecloud_admin_pw)
+        try:
+            create_azure_account(client, azure_data, use_managed_identity, imds)
+        except CycleCloudApiUnavailable as e:
+            print("CycleCloud account REST API unavailable (%s), falling back to the CLI" % e)
+            initialize_cyclecloud_cli(admin_user, cyclecloud_admin_pw, webserver_port)
+            cli_initialized = True
+            create_azure_account_cli(azure_data, use_managed_identity, imds=imds)
+        finally:
+            client.close()
+
+    if extra_accounts:
+        use_cli = False
+        client = CycleCloudClient("localhost", webserver_port, admin_user, cyclecloud_admin_pw)
+        try:
+            client.list_accounts()
+        except CycleCloudApiUnavailable as e:
+            print("CycleCloud account REST API unavailable (%s), registering accounts with the CLI" % e)
+            use_cli = True
+            if not cli_initialized:
+                initialize_cyclecloud_cli(admin_user, cyclecloud_admin_pw, webserver_port)
+                cli_initialized = True
+        finally:
+            client.close()
+        register_azure_accounts(extra_accounts,
+                                lambda: CycleCloudClient("localhost", webserver_port, admin_user, cyclecloud_admin_pw),
+                                use_cli=use_cli, concurrency=account_concurrency, imds=imds)
+
+    if initialize_cli and not cli_initialized:
+        initialize_cyclecloud_cli(admin_user, cyclecloud_admin_pw, webserver_port)
+
+
+def azure_account_data(name, subscription_id, tenant_id, application_id, application_secret,
+                       use_managed_identity, azure_cloud, location, resource_group, storage_account_name,
+                       default_account=False):
+    return {
+        "Environment": azure_cloud,
+        "AzureRMUseManagedIdentity": bool(use_managed_identity),
+        "AzureResourceGroup": resource_group,
+        "AzureRMApplicationId": application_id,
+        "AzureRMApplicationSecret": application_secret,
+        "AzureRMSubscriptionId": subscription_id,
+        "AzureRMTenantId": tenant_id,
+        "DefaultAccount": default_account,
+        "Location": location,
+        "Name": name,
+        "Provider": "azure",
+        "ProviderId": subscription_id,
+        "RMStorageAccount": storage_account_name,
+        "RMStorageContainer": "cyclecloud"
+    }
 
-            print("CycleCloud account data:")
-            print(json.dumps(azure_data))
 
-            # wait until Managed Identity is ready for use before creating the Account
-            if use_managed_identity:
-                get_vm_managed_identity()
+def load_accounts_manifest(manifest_file, vm_metadata, tenant_id, application_id, application_secret,
+                           use_managed_identity, azure_cloud):
+    # The manifest is a JSON list of accounts (or {"accounts": [...]}), each with at
+    # least "name" and "subscriptionId".  Other fields default to the values used
+    # for the default account:
+    #   tenantId, applicationId, applicationSecret, useManagedIdentity,
+    #   azureSovereignCloud, location, resourceGroup, storageAccount, defaultAccount
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if isinstance(manifest, dict):
+        manifest = manifest.get("accounts", [])
+
+    accounts = []
+    for entry in manifest:
+        if not entry.get("name") or not entry.get("subscriptionId"):
+            raise Exception("Accounts manifest entry needs a name and subscriptionId: %s" % entry.get("name"))
+        storage_account = entry.get("storageAccount") or 'cyclecloud{}'.format(
+            ''.join(random.SystemRandom().choice(ascii_lowercase) for _ in range(14)))
+        accounts.append(azure_account_data(entry["name"], entry["subscriptionId"],
+                                           entry.get("tenantId", tenant_id),
+                                           entry.get("applicationId", application_id),
+                                           entry.get("applicationSecret", application_secret),
+                                           entry.get("useManagedIdentity", use_managed_identity),
+                                           entry.get("azureSovereignCloud", azure_cloud),
+                                           entry.get("location", vm_metadata["compute"]["location"]),
+                                           entry.get("resourceGroup", vm_metadata["compute"]["resourceGroupName"]),
+                                           storage_account,
+                                           default_account=entry.get("defaultAccount", False)))
+    names = [a["Name"] for a in accounts]
+    duplicates = sorted(set(n for n in names if names.count(n) > 1))
+    if duplicates:
+        raise Exception("Duplicate account names in accounts manifest: %s" % ", ".join(duplicates))
+    return accounts
+
+
+def register_azure_accounts(accounts, client_factory, use_cli=False, concurrency=4, max_tries=3, imds=None):
+    # Register many accounts through a bounded pool, each worker with its own
+    # connection to CycleServer.  Failed accounts are retried with backoff and
+    # reported in the summary rather than stopping the others.
+    if any(a["AzureRMUseManagedIdentity"] for a in accounts):
+        # wait until Managed Identity is ready for use before creating the Accounts
+        get_vm_managed_identity(imds)
+
+    local = threading.local()
+    clients = []
+    clients_lock = threading.Lock()
+
+    def register(account_data):
+        outcome = {"name": account_data["Name"], "status": "failed", "attempts": 0, "error": None}
+        started = monotonic()
+        for attempt in range(max_tries):
+            outcome["attempts"] = attempt + 1
+            try:
+                if use_cli:
+                    if not create_azure_account_cli(account_data, False, quiet=True):
+                        outcome["status"] = "exists"
+                        break
+                else:
+                    if getattr(local, "client", None) is None:
+                        local.client = client_factory()
+                        with clients_lock:
+                            clients.append(local.client)
+                    if local.client.get_account(account_data["Name"]):
+                        outcome["status"] = "exists"
+                        break
+                    local.client.create_account(account_data)
+                outcome["status"] = "created"
+                outcome["error"] = None
+                break
+            except Exception as e:
+                outcome["error"] = "%s: %s" % (type(e).__name__, e)
+                if attempt + 1 < max_tries:
+                    print("Registering account {} failed ({}), retrying".format(account_data["Name"], e))
+                    sleep(random.uniform(0, 2 ** attempt))
+        outcome["duration"] = monotonic() - started
+        return outcome
+
+    with span("register_azure_accounts", kind="wait", accounts=len(accounts)) as record:
+        print("Registering {} Azure accounts in CycleCloud ({} at a time)".format(len(accounts), concurrency))
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="account") as pool:
+                outcomes = list(pool.map(register, accounts))
+        finally:
+            for client in clients:
+                client.close()
+        record["outcomes"] = outcomes
+
+    print("%-32s %-8s %8s %10s %s" % ("account", "status", "attempts", "duration", "error"))
+    for outcome in outcomes:
+        print("%-32s %-8s %8d %9.1fs %s" % (outcome["name"], outcome["status"], outcome["attempts"],
+                                            outcome["duration"], outcome["error"] or ""))
+    failed = [o["name"] for o in outcomes if o["status"] == "failed"]
+    print("Accounts: {} created, {} already existed, {} failed".format(
+        len([o for o in outcomes if o["status"] == "created"]),
+        len([o for o in outcomes if o["status"] == "exists"]), len(failed)))
+    if failed:
+        raise Exception("Failed to register accounts: %s" % ", ".join(failed))
+    return outcomes
+
+
+class CycleCloudApiUnavailable(Exception):
+    pass
+
+
+class CycleCloudCredentialsRejected(Exception):
+    pass
+
+
+class CycleCloudClient(object):
+    # Minimal REST client for the local CycleServer.  Keeps one keep-alive
+    # HTTPS connection (the server starts with a self-signed certificate) and
+    # authenticates every request with HTTP basic auth.
+
+    ACCOUNTS_PATH = "/cloud/accounts"
+
+    def __init__(self, host, port, username, password, use_https=True, timeout=60):
+        import base64
+        self.host = host
+        self.port = int(port)
+        self.use_https = use_https
+        self.timeout = timeout
+        token = base64.b64encode("{}:{}".format(username, password).encode("utf-8")).decode("ascii")
+        self._headers = {"Authorization": "Basic " + token,
+                         "Accept": "application/json"}
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        import http.client
+        import ssl
+        if self.use_https:
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def request(self, method, url_path, body=None):
+        # Returns (status, parsed JSON body or None).  A dropped keep-alive
+        # connection is re-opened once before giving up.
+        import http.client
+        headers = dict(self._headers)
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._conn is None:
+                        self._conn = self._connect()
+                    self._conn.request(method, url_path, body=payload, headers=headers)
+                    response = self._conn.getresponse()
+                    data = response.read()
+                    break
+                except (OSError, http.client.HTTPException):
+                    if self._conn is not None:
+                        self._conn.close()
+                        self._conn = None
+                    if attempt:
+                        raise
+        content_type = response.getheader("Content-Type", "")
+        parsed = None
+        if data and "json" in content_type:
+            parsed = json.loads(data.decode("utf-8"))
+        return response.status, parsed
+
+    def _check(self, status, url_path):
+        if status in (404, 405, 501):
+            raise CycleCloudApiUnavailable("HTTP {} from {}".format(status, url_path))
+        if status in (401, 403):
+            raise CycleCloudCredentialsRejected("CycleCloud rejected the credentials for {} (HTTP {})".format(
+                url_path, status))
+        if status >= 400:
+            raise Exception("CycleCloud request {} failed with HTTP {}".format(url_path, status))
+
+    def credentials_valid(self):
+        # Only an account list proves the credentials work.  False when the
+        # server rejects them; any other response (a redirect to the login
+        # page, an HTML page, an error) can't verify them and raises.
+        try:
+            self.list_accounts()
+        except CycleCloudCredentialsRejected:
+            return False
+        return True
+
+    def list_accounts(self):
+        status, accounts = self.request("GET", self.ACCOUNTS_PATH)
+        self._check(status, self.ACCOUNTS_PATH)
+        if not isinstance(accounts, list):
+            raise CycleCloudApiUnavailable("unexpected response from {}".format(self.ACCOUNTS_PATH))
+        return accounts
+
+    def get_account(self, name):
+        for account in self.list_accounts():
+            if account.get("Name") == name:
+                return account
+        return None
+
+    def create_account(self, account_data):
+        # The endpoint isn't documented, so only trust a JSON echo of the new
+        # account that a fresh lookup then confirms.  Anything else (a redirect
+        # to the login page, an HTML page) leaves creation to the CLI.
+        status, created = self.request("POST", self.ACCOUNTS_PATH, account_data)
+        self._check(status, self.ACCOUNTS_PATH)
+        if status not in (200, 201) or not isinstance(created, dict) or created.get("Name") != account_data["Name"]:
+            raise CycleCloudApiUnavailable("unexpected HTTP {} response from {}".format(status, self.ACCOUNTS_PATH))
+        if not self.get_account(account_data["Name"]):
+            raise CycleCloudApiUnavailable("account {} not listed after creating it through {}".format(
+                account_data["Name"], self.ACCOUNTS_PATH))
+        return created
+
+
+def create_azure_account(client, azure_data, use_managed_identity, imds=None):
+    if client.get_account(azure_data["Name"]):
+        print("Account \"%s\" already exists.   Skipping account setup..." % azure_data["Name"])
+        return
+
+    print("CycleCloud account data:")
+    print(json.dumps(azure_data))
+
+    # wait until Managed Identity is ready for use before creating the Account
+    if use_managed_identity:
+        get_vm_managed_identity(imds)
+
+    # create the cloud provide account
+    print("Registering Azure subscription in CycleCloud")
+    client.create_account(azure_data)
 
-            # create the cloud provide account
-            print("Registering Azure subscription in CycleCloud")
-            _catch_sys_error(["/usr/local/bin/cyclecloud", "account",
-                            "create", "-f", azure_data_file])
 
+def create_azure_account_cli(azure_data, use_managed_identity, quiet=False, imds=None):
+    output =  _catch_sys_error([cyclecloud_cli, "account", "show", azure_data["Name"]])
+    if 'Credentials: %s' % azure_data["Name"] in str(output):
+        print("Account \"%s\" already exists.   Skipping account setup..." % azure_data["Name"])
+        return False
+
+    # Concurrent registrations each need their own data file
+    fh, azure_data_file = mkstemp(dir=tmpdir, prefix="azure_data_", suffix=".json")
+    with fdopen(fh, 'w') as fp:
+        json.dump(azure_data, fp)
+
+    if not quiet:
+        print("CycleCloud account data:")
+        print(json.dumps(azure_data))
+
+    # wait until Managed Identity is ready for use before creating the Account
+    if use_managed_identity:
+        get_vm_managed_identity(imds)
+
+    # create the cloud provide account
+    print("Registering Azure subscription %s in CycleCloud" % azure_data["AzureRMSubscriptionId"])
+    _catch_sys_error([cyclecloud_cli, "account",
+                    "create", "-f", azure_data_file])
+    return True
+
+
+def stored_cli_password(admin_user, webserver_port, config_file=cli_config_file):
+    # The password "cyclecloud initialize" saved for admin_user on this server, if any
+    import configparser
+    from urllib.parse import urlparse
+    parser = configparser.RawConfigParser()
+    try:
+        if not parser.read(config_file):
+            return None
+    except configparser.Error as e:
+        print("Ignoring unreadable CLI configuration {}: {}".format(config_file, e))
+        return None
+    for section in parser.sections():
+        settings = dict(parser.items(section))
+        url = urlparse(settings.get("url", ""))
+        try:
+            port = url.port
+        except ValueError:
+            continue
+        if (settings.get("username") == admin_user and settings.get("password") and
+                url.hostname in ("localhost", "127.0.0.1") and port == int(webserver_port)):
+            return settings["password"]
+    return None
+
+def admin_password(admin_user, password, webserver_port):
+    # The password account setup used in this run or, when the journal skipped
+    # account setup, the given one or the one the CLI was initialized with
+    return _admin_passwords.get(admin_user) or password or stored_cli_password(admin_user, webserver_port)
+
+def cyclecloud_credentials_valid(admin_user, password, webserver_port):
+    # Credentials that can't be verified are treated as invalid, so the
+    # password is reset and the CLI initialized again
+    client = CycleCloudClient("localhost", webserver_port, admin_user, password, timeout=10)
+    with span("verify_credentials", kind="wait") as record:
+        try:
+            record["valid"] = client.credentials_valid()
+        except Exception as e:
+            print("Unable to verify the stored CLI credentials ({})".format(e))
+            record["valid"] = False
+        finally:
+            client.close()
+    return record["valid"]
 
 def initialize_cyclecloud_cli(admin_user, cyclecloud_admin_pw, webserver_port):
     print("Setting up azure account in CycleCloud and initializing cyclecloud CLI")
@@ -261,83 +1115,834 @@ def initialize_cyclecloud_cli(admin_user, cyclecloud_admin_pw, webserver_port):
     password_flag = ("--password=%s" % cyclecloud_admin_pw)
 
     print("Initializing cylcecloud CLI")
-    _catch_sys_error(["/usr/local/bin/cyclecloud", "initialize", "--loglevel=debug", "--batch", "--force",
+    _catch_sys_error([cyclecloud_cli, "initialize", "--loglevel=debug", "--batch", "--force",
                       "--url=https://localhost:{}".format(webserver_port), "--verify-ssl=false", "--username=%s" % admin_user, password_flag])
 
 
-def letsEncrypt(fqdn):
-    sleep(60)
+@timed_phase
+def letsEncrypt(fqdn, http_port=80, deadline=LETSENCRYPT_DEADLINE):
+    # Certificate acquisition can take minutes (and may never succeed, e.g.
+    # without a public IP), so it runs in a detached worker process and the
+    # install completes as soon as the server is usable.  The outcome is
+    # recorded in LETSENCRYPT_STATUS_FILE.
+    status = read_letsencrypt_status()
+    if status.get("fqdn") == fqdn and status.get("state") == "succeeded":
+        print("Let's Encrypt certificate for {} already installed".format(fqdn))
+        return status
+    if status.get("state") in ("pending", "running") and _pid_running(status.get("pid")):
+        print("Let's Encrypt worker for {} already running (pid {})".format(status.get("fqdn"), status.get("pid")))
+        return status
+
+    cmd = [sys.executable, path.abspath(__file__), "--letsEncryptWorker",
+           "--hostname", fqdn,
+           "--webServerPort", str(http_port),
+           "--letsEncryptDeadline", str(deadline)]
+    with open(LETSENCRYPT_LOG_FILE, 'a') as log:
+        worker = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                  close_fds=True, start_new_session=True)
+    status = {"state": "pending", "fqdn": fqdn, "pid": worker.pid, "queued": time()}
+    write_letsencrypt_status(status)
+    print("Requesting Let's Encrypt certificate for {} in the background (pid {}, log {}, status {})".format(
+        fqdn, worker.pid, LETSENCRYPT_LOG_FILE, LETSENCRYPT_STATUS_FILE))
+    return status
+
+
+def _pid_running(pid):
+    if not pid:
+        return False
     try:
-        cmd_list = [cs_cmd, "keystore", "automatic", "--accept-terms", fqdn]
-        output = check_output(cmd_list)
-        print(cmd_list)
-        print(output)
-    except CalledProcessError as e:
-        print("Error getting SSL cert from Lets Encrypt")
-        print("Proceeding with self-signed cert")
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def read_letsencrypt_status():
+    return _read_json_state(LETSENCRYPT_STATUS_FILE)
 
 
-def get_vm_metadata():
-    metadata_url = "http://169.254.169.254/metadata/instance?api-version=2017-08-01"
-    metadata_req = Request(metadata_url, headers={"Metadata": True})
+def write_letsencrypt_status(status):
+    _write_json_state(LETSENCRYPT_STATUS_FILE, status, "Let's Encrypt status")
 
-    for _ in range(30):
-        print("Fetching metadata")
-        metadata_response = urlopen(metadata_req, timeout=2)
 
+def letsencrypt_ready(fqdn, http_port):
+    # Returns None when an HTTP-01 challenge can work, otherwise what is missing
+    import socket
+    try:
+        addresses = sorted(set(a[4][0] for a in socket.getaddrinfo(fqdn, http_port, 0, socket.SOCK_STREAM)))
+    except socket.gaierror as e:
+        return "%s does not resolve yet (%s)" % (fqdn, e)
+    try:
+        socket.create_connection(("localhost", http_port), timeout=5).close()
+    except (IOError, OSError) as e:
+        return "CycleCloud is not listening on port %s yet (%s)" % (http_port, e)
+    print("{} resolves to {}, port {} is open".format(fqdn, ", ".join(addresses), http_port))
+    return None
+
+
+def letsencrypt_worker(fqdn, http_port=80, deadline=LETSENCRYPT_DEADLINE, max_attempts=LETSENCRYPT_MAX_ATTEMPTS):
+    # Wait until the FQDN resolves and the server is reachable, then request the
+    # certificate, retrying with backoff.  Attempts are capped because Let's
+    # Encrypt only allows a handful of failed validations per hour.
+    started = monotonic()
+    status = {"state": "running", "fqdn": fqdn, "pid": os.getpid(), "started": time(), "attempts": 0}
+    write_letsencrypt_status(status)
+    expires = started + deadline
+    backoff = 5.0
+    while True:
+        problem = letsencrypt_ready(fqdn, http_port)
+        if problem is None:
+            status["attempts"] += 1
+            try:
+                _catch_sys_error([cs_cmd, "keystore", "automatic", "--accept-terms", fqdn])
+                status["state"] = "succeeded"
+                break
+            except (CalledProcessError, subprocess.TimeoutExpired) as e:
+                problem = "keystore automatic failed: %s" % e
+                # Failed validations count against the rate limit, so back off harder
+                backoff = max(backoff, 60.0)
+        status["last_error"] = problem
+        write_letsencrypt_status(status)
+        remaining = expires - monotonic()
+        if status["attempts"] >= max_attempts or remaining <= 0:
+            status["state"] = "failed"
+            break
+        print("Let's Encrypt not possible yet: {}; retrying in {:.0f}s".format(problem, min(backoff, remaining)))
+        sleep(min(backoff, remaining))
+        backoff = min(backoff * 2, 600.0)
+
+    status["finished"] = time()
+    status["duration"] = monotonic() - started
+    write_letsencrypt_status(status)
+    if status["state"] == "succeeded":
+        print("Installed Let's Encrypt certificate for {} after {:.0f}s".format(fqdn, status["duration"]))
+    else:
+        print("Error getting SSL cert from Lets Encrypt: {}".format(status.get("last_error")))
+        print("Proceeding with self-signed cert")
+    return status
+
+
+def load_warmup_requests(requests_file=None):
+    # A JSON list of URL paths or {"method", "path", "body"} objects
+    if not requests_file:
+        return [{"method": "GET", "path": p, "body": None} for p in WARMUP_REQUESTS]
+    with open(requests_file) as f:
+        entries = json.load(f)
+    requests = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            entry = {"path": entry}
+        if not str(entry.get("path", "")).startswith("/"):
+            raise Exception("Warm-up request needs a path starting with /: %s" % entry)
+        requests.append({"method": entry.get("method", "GET").upper(), "path": entry["path"],
+                         "body": entry.get("body")})
+    if not requests:
+        raise Exception("No warm-up requests in %s" % requests_file)
+    return requests
+
+
+@timed_phase
+def warmup(webserver_port, admin_user, password, requests_file=None, rounds=WARMUP_ROUNDS,
+           concurrency=WARMUP_CONCURRENCY, templates_dir=None):
+    # The first requests to a fresh server pay for class loading, JIT and
+    # empty caches.  A detached worker takes that cost instead of the first
+    # users, without holding up the install; the outcome is recorded in
+    # WARMUP_STATUS_FILE.
+    if not password:
+        print("WARNING: No admin password known to this run (generated earlier, CLI not initialized), "
+              "skipping the warm-up; pass --password to warm up")
+        return {"state": "skipped"}
+    status = read_warmup_status()
+    if status.get("state") in ("pending", "running") and _pid_running(status.get("pid")):
+        print("Warm-up worker already running (pid {})".format(status.get("pid")))
+        return status
+    load_warmup_requests(requests_file)
+
+    cmd = [sys.executable, path.abspath(__file__), "--warmupWorker",
+           "--username", admin_user,
+           "--webServerSslPort", str(webserver_port),
+           "--warmupRounds", str(rounds),
+           "--warmupConcurrency", str(concurrency)]
+    if requests_file:
+        cmd += ["--warmupRequests", path.abspath(requests_file)]
+    if templates_dir:
+        cmd += ["--warmupTemplates", path.abspath(templates_dir)]
+    with open(WARMUP_LOG_FILE, 'a') as log:
+        # The password goes through a pipe rather than the command line
+        worker = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT,
+                                  close_fds=True, start_new_session=True)
+    worker.stdin.write(password.encode("utf-8") + b"\n")
+    worker.stdin.close()
+    status = {"state": "pending", "pid": worker.pid, "queued": time()}
+    write_warmup_status(status)
+    print("Warming up CycleCloud in the background (pid {}, log {}, status {})".format(
+        worker.pid, WARMUP_LOG_FILE, WARMUP_STATUS_FILE))
+    return status
+
+
+def read_warmup_status():
+    return _read_json_state(WARMUP_STATUS_FILE)
+
+
+def write_warmup_status(status):
+    _write_json_state(WARMUP_STATUS_FILE, status, "warm-up status")
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    def rank(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+    return {"count": len(values), "p50": rank(0.5), "p90": rank(0.9), "p99": rank(0.99), "max": values[-1]}
+
+
+def import_cluster_templates(templates_dir, concurrency=WARMUP_CONCURRENCY):
+    # Templates are imported by the CLI ("cyclecloud import_template"), one
+    # file per call, so the calls run as one concurrent batch
+    templates = sorted(glob.glob(path.join(templates_dir, "*.txt")))
+    if not templates:
+        print("No cluster templates (*.txt) in {}".format(templates_dir))
+        return 0
+    with span("import_cluster_templates", kind="wait", templates=len(templates)):
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = dict((executor.submit(_catch_sys_error, [cyclecloud_cli, "import_template", "-f", template,
+                                                               "--force"]), template)
+                           for template in templates)
+            failed = []
+            for future in futures:
+                try:
+                    future.result()
+                except (CalledProcessError, subprocess.TimeoutExpired) as e:
+                    print("Failed to import cluster template {}: {}".format(futures[future], e))
+                    failed.append(path.basename(futures[future]))
+    if failed:
+        raise Exception("Failed to import cluster templates: %s" % ", ".join(failed))
+    print("Imported {} cluster templates from {}".format(len(templates), templates_dir))
+    return len(templates)
+
+
+def warmup_worker(webserver_port, admin_user, password, requests, rounds=WARMUP_ROUNDS,
+                  concurrency=WARMUP_CONCURRENCY, templates_dir=None):
+    # One measured pass while the server is cold, the warm-up rounds (and the
+    # template import), then a measured pass on the warm server.  Every pass
+    # issues each request concurrency times across concurrency connections.
+    import http.client
+    started = monotonic()
+    status = {"state": "running", "pid": os.getpid(), "started": time(), "rounds": rounds,
+              "concurrency": concurrency, "requests": [r["path"] for r in requests]}
+    write_warmup_status(status)
+    clients = []
+    local = threading.local()
+
+    def timed_request(request):
+        if not hasattr(local, "client"):
+            local.client = CycleCloudClient("localhost", webserver_port, admin_user, password)
+            clients.append(local.client)
+        request_started = monotonic()
         try:
-            return json.load(metadata_response)
-        except ValueError as e:
-            print("Failed to get metadata %s" % e)
-            print("    Retrying")
-            sleep(2)
-            continue
-        except:
-            print("Unable to obtain metadata after 30 tries")
-            raise
+            code, _ = local.client.request(request["method"], request["path"], request["body"])
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            code = type(e).__name__
+        return monotonic() - request_started, str(code)
+
+    def run_pass(executor):
+        results = list(executor.map(timed_request, requests * concurrency))
+        statuses = {}
+        for _, code in results:
+            statuses[code] = statuses.get(code, 0) + 1
+        summary = _percentiles([latency for latency, _ in results])
+        summary["statuses"] = statuses
+        return summary
 
-def get_vm_managed_identity():
-    # Managed Identity may  not be available immediately at VM startup...
-    # Test/Pause/Retry to see if it gets assigned
-    metadata_url = 'http://169.254.169.254/metadata/identity/oauth2/token?api-version=2018-02-01&resource=https://management.azure.com/'
-    metadata_req = Request(metadata_url, headers={"Metadata": True})
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            status["before"] = run_pass(executor)
+            write_warmup_status(status)
+            if templates_dir:
+                status["templates"] = import_cluster_templates(templates_dir, concurrency)
+            for _ in range(rounds):
+                run_pass(executor)
+            status["after"] = run_pass(executor)
+        # e.g. rejected credentials: nothing was warmed beyond the error path
+        if not any(code.isdigit() and int(code) < 400 for code in status["after"]["statuses"]):
+            raise Exception("no successful responses (statuses {})".format(
+                ", ".join("{} x{}".format(code, n) for code, n in sorted(status["after"]["statuses"].items()))))
+        status["state"] = "succeeded"
+    except Exception as e:
+        status["state"] = "failed"
+        status["last_error"] = "%s: %s" % (type(e).__name__, e)
+    finally:
+        for client in clients:
+            client.close()
+    status["finished"] = time()
+    status["duration"] = monotonic() - started
+    write_warmup_status(status)
+    if status["state"] == "succeeded":
+        print("Warm-up finished after {:.1f}s: p50 {:.3f}s -> {:.3f}s, p99 {:.3f}s -> {:.3f}s".format(
+            status["duration"], status["before"]["p50"], status["after"]["p50"],
+            status["before"]["p99"], status["after"]["p99"]))
+    else:
+        print("Warm-up failed: {}".format(status["last_error"]))
+    return status
+
+
+class ImdsClient(object):
+    # Client for the Azure Instance Metadata Service.  Keeps one keep-alive
+    # connection to the endpoint and retries connection errors, throttling and
+    # server errors with jittered exponential backoff under an overall deadline.
+    # Requests are serialized, so one client can be shared between install steps.
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, endpoint=IMDS_ENDPOINT, timeout=2):
+        from urllib.parse import urlsplit
+        parts = urlsplit(endpoint)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _request(self, url):
+        import http.client
+        with self._lock:
+            try:
+                if self._conn is None:
+                    self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+                self._conn.request("GET", url, headers={"Metadata": "true"})
+                response = self._conn.getresponse()
+                return response.status, response.read()
+            except (OSError, http.client.HTTPException):
+                # Don't try to reuse a connection in an unknown state
+                self._close()
+                raise
+
+    def get_json(self, url_path, params, deadline=60, retry_statuses=RETRY_STATUSES, max_backoff=8.0,
+                 validate=None):
+        from urllib.parse import urlencode
+        import http.client
+        url = "{}?{}".format(url_path, urlencode(params))
+        expires = monotonic() + deadline
+        attempt = 0
+        while True:
+            try:
+                status, body = self._request(url)
+                if status == 200:
+                    # A truncated or unexpected document is retried like any other transient failure
+                    data = json.loads(body.decode("utf-8"))
+                    if validate is None or validate(data):
+                        return data
+                    error = "unexpected response: {}".format(body[:200])
+                elif status in retry_statuses:
+                    error = "HTTP {}: {}".format(status, body[:200])
+                else:
+                    raise Exception("IMDS request {} failed with HTTP {}: {}".format(url_path, status, body[:200]))
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                error = "%s: %s" % (type(e).__name__, e)
+
+            attempt += 1
+            remaining = expires - monotonic()
+            if remaining <= 0:
+                raise Exception("IMDS request {} failed after {} attempts: {}".format(url_path, attempt, error))
+            # Full jitter, so concurrent callers don't retry in lock step
+            delay = random.uniform(0, min(max_backoff, 0.25 * 2 ** attempt))
+            print("IMDS request {} failed ({}), retrying in {:.1f}s".format(url_path, error, delay))
+            note_retry()
+            sleep(min(delay, remaining))
+
+    def instance(self, deadline=60):
+        return self.get_json("/metadata/instance", {"api-version": IMDS_API_VERSION}, deadline=deadline)
+
+    def managed_identity_token(self, resource=ARM_RESOURCE, deadline=300):
+        # The identity may not be assigned yet at VM startup, which IMDS reports as a 400/404
+        return self.get_json("/metadata/identity/oauth2/token",
+                             {"api-version": "2018-02-01", "resource": resource},
+                             deadline=deadline,
+                             retry_statuses=self.RETRY_STATUSES + (400, 404),
+                             max_backoff=5.0,
+                             validate=lambda token: isinstance(token, dict) and bool(token.get("access_token")))
+
+
+def _vm_uuid():
+    try:
+        with open("/sys/class/dmi/id/product_uuid") as f:
+            return f.read().strip().lower()
+    except (IOError, OSError):
+        return None
+
+@timed_phase
+def get_vm_metadata(imds=None, cache_file=IMDS_CACHE_FILE):
+    # The instance document doesn't change for the life of the VM, so re-runs of
+    # the extension reuse the cached copy.  The cache is keyed by the SMBIOS
+    # UUID, so an image captured from this VM won't reuse it.
+    vm_uuid = _vm_uuid()
+    if cache_file and vm_uuid and path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cached = json.load(f)
+            if cached.get("vm_uuid") == vm_uuid and cached.get("api_version") == IMDS_API_VERSION:
+                print("Using cached VM metadata from {}".format(cache_file))
+                return cached["metadata"]
+        except (IOError, OSError, ValueError, KeyError) as e:
+            print("Ignoring unreadable metadata cache {}: {}".format(cache_file, e))
+
+    print("Fetching metadata")
+    imds = imds or ImdsClient()
+    metadata = imds.instance()
+
+    if cache_file and vm_uuid:
+        try:
+            _atomic_write(cache_file, json.dumps({"vm_uuid": vm_uuid,
+                                                  "api_version": IMDS_API_VERSION,
+                                                  "metadata": metadata}), mode=0o600)
+        except (IOError, OSError) as e:
+            print("Unable to cache VM metadata: %s" % e)
+    return metadata
+
+# Managed identity tokens by resource, as (token, expires_on), shared by every
+# caller in the run.  The first fetch is recorded for the install profile.
+_identity_tokens = {}
+_identity_lock = threading.Lock()
+_identity_report = {}
+
+def _token_expires_on(token, fetched):
+    # IMDS gives expires_on in epoch seconds (as a string); fall back to expires_in
+    try:
+        return float(token["expires_on"])
+    except (KeyError, TypeError, ValueError):
+        pass
+    try:
+        return fetched + float(token["expires_in"])
+    except (KeyError, TypeError, ValueError):
+        return fetched
 
-    for _ in range(30):
+def get_vm_managed_identity(imds=None, resource=ARM_RESOURCE, min_lifetime=IDENTITY_TOKEN_MIN_LIFETIME):
+    # Managed Identity may  not be available immediately at VM startup...
+    # Test/Pause/Retry to see if it gets assigned.  The token is cached until
+    # it is close to expiry; concurrent callers wait for a single fetch.
+    # Each caller's deadline runs from its own call, so time spent waiting on a
+    # fetch that then fails (the prefetch) counts against it, but a caller that
+    # arrives after that failure still polls for the full deadline.
+    started = monotonic()
+    with _identity_lock:
+        cached = _identity_tokens.get(resource)
+        if cached and cached[1] - time() > min_lifetime:
+            return cached[0]
         print("Fetching managed identity")
-        metadata_response = urlopen(metadata_req, timeout=2)
-
+        imds = imds or ImdsClient()
+        with span("managed_identity_token", kind="wait", resource=resource) as record:
+            # get_json always makes one request, even with no time left
+            remaining = max(0, IDENTITY_TOKEN_DEADLINE - (monotonic() - started))
+            token = imds.managed_identity_token(resource, deadline=remaining)
+            expires_on = _token_expires_on(token, time())
+            record["expires_on"] = expires_on
+        _identity_tokens[resource] = (token, expires_on)
+        if "available_at" not in _identity_report:
+            _identity_report.update({"available_at": time(), "resource": resource, "expires_on": expires_on})
+        print("Managed identity token for {} valid until {}".format(
+            resource, strftime("%Y-%m-%d %H:%M:%S", gmtime(expires_on))))
+        return token
+
+@timed_phase
+def prefetch_managed_identity(imds=None):
+    # Starts fetching the token on a daemon thread, so the wait for the identity
+    # to be assigned overlaps package installation and startup without holding
+    # up the install when the token isn't needed (the account exists, or the
+    # journal skips account setup).  A caller that does need it waits on
+    # _identity_lock for the fetch in flight.  Failures are left for
+    # cyclecloud_account_setup to report.
+    def fetch():
         try:
-            return json.load(metadata_response)
-        except ValueError as e:
-            print("Failed to get managed identity %s" % e)
-            print("    Retrying")
-            sleep(10)
-            continue
-        except:
-            print("Unable to obtain managed identity after 30 tries")
-            raise    
+            get_vm_managed_identity(imds)
+        except Exception as e:
+            print("Managed identity not yet available: %s" % e)
+    threading.Thread(target=fetch, name="identity-prefetch", daemon=True).start()
+    return True
+
+@timed_phase
+def start_cc(startup_timeout=STARTUP_TIMEOUT, force_restart=False, restore_backup=None):
+    # Restarting costs minutes of downtime, so leave a healthy server alone
+    # unless its configuration changed since it was last (re)started here
+    corrupt = datastore_corrupt()
+    config_hash = cs_config_hash()
+    last_start = read_start_state()
+    if force_restart:
+        reason = "--forceRestart given"
+    elif corrupt:
+        reason = "datastore is corrupt"
+    elif last_start.get("config_hash") != config_hash:
+        reason = "configuration changed since the last start" if last_start else "no record of a previous start"
+    elif not cycleserver_responding():
+        reason = "server is not responding"
+    else:
+        print("CycleCloud server is running and its configuration is unchanged, skipping restart")
+        return False
+    print("(Re-)Starting CycleCloud server: %s" % reason)
 
-def start_cc():
-    import glob
-    import subprocess
-    print("(Re-)Starting CycleCloud server")
     _catch_sys_error([cs_cmd, "stop"])
-    if glob.glob("/opt/cycle_server/data/ads/corrupt*") or glob.glob("/opt/cycle_server/data/ads/*logfile_failure"):
+    if corrupt:
         print("WARNING: Corrupted datastore masterlog detected.   Restoring from last backup...")
-        if not glob.glob("/opt/cycle_server/data/backups/backup-*"):
-            raise Exception("ERROR: No backups found, but master.logfile is corrupt!")
-        try:
-            yes = subprocess.Popen(['echo', 'yes'], stdout=subprocess.PIPE)
-            output = subprocess.check_output(['/opt/cycle_server/util/restore.sh'], stdin=yes.stdout)
-            yes.wait()
-            print(output)
-        except CalledProcessError as e:
-            print("Error with cmd: %s" % e.cmd)
-            print("Output: %s" % e.output)
-            raise
+        restore_datastore(restore_backup)
     
     _catch_sys_error([cs_cmd, "start"])
+    wait_until_ready(startup_timeout)
+    write_start_state(config_hash)
+    return True
+
+
+def wait_until_ready(startup_timeout=STARTUP_TIMEOUT):
+    target = cycleserver_probe_target()
+    if target:
+        await_cycleserver_ready(*target, timeout=startup_timeout)
+    else:
+        await_startup()
+
+
+# --upgrade keeps a copy of the datastore and configuration here.  It is kept
+# between upgrades, so each one only copies what changed since the last.
+UPGRADE_BACKUP_DIR = cycle_root + "/data/upgrade_backup"
+UPGRADE_BACKUP_PATHS = ("data/ads", "config")
+
+def sync_tree(src, dest):
+    # Make dest a copy of src, copying only the files whose size or mtime
+    # differ and removing what src no longer has.  Returns (files, bytes) copied.
+    copied = copied_bytes = 0
+    wanted = set()
+    for root, _, files in os.walk(src):
+        target_root = path.normpath(path.join(dest, path.relpath(root, src)))
+        wanted.add(target_root)
+        if not path.isdir(target_root):
+            os.makedirs(target_root)
+        for name in files:
+            source, target = path.join(root, name), path.join(target_root, name)
+            wanted.add(target)
+            st = os.lstat(source)
+            try:
+                existing = os.lstat(target)
+                if existing.st_size == st.st_size and existing.st_mtime_ns == st.st_mtime_ns:
+                    continue
+            except FileNotFoundError:
+                pass
+            copy2(source, target, follow_symlinks=False)
+            copied += 1
+            copied_bytes += st.st_size
+    for root, dirs, files in os.walk(dest, topdown=False):
+        for name in files:
+            if path.join(root, name) not in wanted:
+                remove(path.join(root, name))
+        for name in dirs:
+            if path.join(root, name) not in wanted:
+                rmtree(path.join(root, name))
+    return copied, copied_bytes
+
+def backup_for_upgrade(backup_dir=UPGRADE_BACKUP_DIR):
+    copied = copied_bytes = 0
+    for relative in UPGRADE_BACKUP_PATHS:
+        files, nbytes = sync_tree(path.join(cycle_root, relative), path.join(backup_dir, relative))
+        copied += files
+        copied_bytes += nbytes
+    print("Upgrade backup in {}: copied {} files ({:.1f} MB)".format(backup_dir, copied, copied_bytes / (1024.0 * 1024)))
+    return copied, copied_bytes
+
+def upgrade_candidate(pkg_mgr, name):
+    # The newest version of name the repositories offer, or None if it's the installed one
+    if pkg_mgr == "apt":
+        cmd = ["apt-cache", "policy", name]
+    else:
+        cmd = ["yum", "-q", "list", "updates", name]
+    # yum exits non-zero when there is no update, so don't check the status
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    output = proc.stdout.decode("utf-8", "replace")
+    if pkg_mgr == "apt":
+        installed = re.search(r"^\s*Installed:\s*(\S+)", output, re.M)
+        candidate = re.search(r"^\s*Candidate:\s*(\S+)", output, re.M)
+        if not candidate or candidate.group(1) == "(none)":
+            return None
+        if installed and installed.group(1) == candidate.group(1):
+            return None
+        return candidate.group(1)
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].split(".")[0] == name:
+            return fields[1]
+    return None
+
+def download_packages(pkg_mgr, specs, reinstall=False):
+    if pkg_mgr == "apt":
+        _catch_sys_error(["apt-get", "install", "-y", "--download-only"] +
+                         (["--reinstall", "--allow-downgrades"] if reinstall else []) + specs)
+    else:
+        _catch_sys_error(["yum", "reinstall" if reinstall else "install", "-y", "--downloadonly"] + specs)
+
+def install_downloaded_packages(pkg_mgr, specs, downgrade=False):
+    # Only from the packages already downloaded, so nothing waits on the network
+    if pkg_mgr == "apt":
+        _catch_sys_error(["apt-get", "install", "-y", "--no-download"] +
+                         (["--allow-downgrades"] if downgrade else []) + specs)
+    else:
+        _catch_sys_error(["yum", "-C", "downgrade" if downgrade else "install", "-y"] + specs)
+
+def rollback_upgrade(pkg_mgr, version, restore_data, startup_timeout=STARTUP_TIMEOUT, backup_dir=UPGRADE_BACKUP_DIR):
+    with span("upgrade_rollback", kind="wait", version=version, restore_data=restore_data):
+        try:
+            _catch_sys_error([cs_cmd, "stop"])
+        except CalledProcessError:
+            print("Unable to stop the upgraded CycleCloud server, continuing the rollback")
+        if version:
+            install_downloaded_packages(pkg_mgr, [_package_spec(pkg_mgr, "cyclecloud8", version)], downgrade=True)
+        if restore_data:
+            for relative in UPGRADE_BACKUP_PATHS:
+                sync_tree(path.join(backup_dir, relative), path.join(cycle_root, relative))
+        _catch_sys_error([cs_cmd, "start"])
+        wait_until_ready(startup_timeout)
+    write_start_state(cs_config_hash())
+
+@timed_phase
+def upgrade_cc(version=None, startup_timeout=STARTUP_TIMEOUT, pkg_mgr=None):
+    # The old server keeps serving while the new package is downloaded and the
+    # datastore is copied, so the stop/start window only holds a final sync of
+    # the copy, a package install that needs no network, and the restart.  If
+    # anything in the window fails, the old package and the copy are put back.
+    pkg_mgr = pkg_mgr or package_manager()
+    name = "cyclecloud8"
+    installed = installed_package_versions(pkg_mgr, [name]).get(name)
+    if pkg_mgr == "apt" and not apt_lists_fresh():
+        _catch_sys_error(["apt", "update", "-y"])
+    target = version or upgrade_candidate(pkg_mgr, name)
+    if not target or _version_satisfied(installed, target):
+        print("CycleCloud {} is up to date, nothing to upgrade".format(installed))
+        return {"from": installed, "to": installed, "downtime": 0.0}
+    print("Upgrading CycleCloud from {} to {}".format(installed, target))
+
+    with span("upgrade_prepare", kind="wait", from_version=installed, to_version=target):
+        download_packages(pkg_mgr, [_package_spec(pkg_mgr, name, target)])
+        rollback_version = installed
+        try:
+            download_packages(pkg_mgr, [_package_spec(pkg_mgr, name, installed)], reinstall=True)
+        except CalledProcessError:
+            print("WARNING: CycleCloud {} can't be downloaded again, so a rollback would only restore "
+                  "the datastore".format(installed))
+            rollback_version = None
+        backup_for_upgrade()
+
+    started = monotonic()
+    stage = "stop"
+    with span("upgrade_window", kind="wait", from_version=installed, to_version=target) as record:
+        try:
+            _catch_sys_error([cs_cmd, "stop"])
+            stage = "backup"
+            # Consistent now that the server is down; only what changed since the pre-copy
+            backup_for_upgrade()
+            stage = "install"
+            install_downloaded_packages(pkg_mgr, [_package_spec(pkg_mgr, name, target)])
+            stage = "start"
+            _catch_sys_error([cs_cmd, "start"])
+            wait_until_ready(startup_timeout)
+        except Exception as e:
+            print("ERROR: Upgrade to {} failed during {} ({}), rolling back to {}".format(target, stage, e, installed))
+            changed = stage in ("install", "start")
+            rollback_upgrade(pkg_mgr, rollback_version if changed else None, changed, startup_timeout)
+            record["rolled_back"] = True
+            record["downtime"] = monotonic() - started
+            print("CycleCloud {} restored after {:.1f}s of downtime".format(installed, record["downtime"]))
+            raise Exception("Upgrade to CycleCloud {} failed and was rolled back: {}".format(target, e))
+        record["downtime"] = monotonic() - started
+    write_start_state(cs_config_hash())
+    print("Upgraded CycleCloud from {} to {} with {:.1f}s of downtime".format(installed, target, record["downtime"]))
+    return {"from": installed, "to": target, "downtime": record["downtime"]}
+
+
+def index_backups(backups_dir=None):
+    # Datastore backups, newest first, each with its timestamp (from the
+    # backup-YYYY-MM-DD_HH-MM-SS name, or the mtime) and size in bytes
+    import calendar
+    backups_dir = backups_dir or cycle_root + "/data/backups"
+    backups = []
+    for backup_path in glob.glob(path.join(backups_dir, "backup-*")):
+        name = path.basename(backup_path)
+        stamp = re.search(r"(\d{4})\D?(\d{2})\D?(\d{2})\D?(\d{2})\D?(\d{2})\D?(\d{2})", name)
+        if stamp:
+            timestamp = calendar.timegm(tuple(int(g) for g in stamp.groups()) + (0, 0, 0))
+        else:
+            timestamp = path.getmtime(backup_path)
+        size = 0
+        if path.isdir(backup_path):
+            for root, _, files in os.walk(backup_path):
+                size += sum(path.getsize(path.join(root, f)) for f in files if not path.islink(path.join(root, f)))
+        else:
+            size = path.getsize(backup_path)
+        backups.append({"name": name, "path": backup_path, "timestamp": timestamp, "size": size})
+    backups.sort(key=lambda b: (b["timestamp"], b["name"]), reverse=True)
+    return backups
+
+# Assumed, not confirmed against a real CycleServer backup: a backup is a copy
+# of data/ads (a directory or a tar archive), so it holds the master.logfile
+# whose corruption datastore_corrupt() detects.  If the layout differs every
+# backup fails validation, and restore_datastore() leaves the choice to
+# restore.sh as before.
+BACKUP_MASTER_LOGFILE = "master.logfile"
+
+def validate_backup(backup):
+    # Returns None if the backup looks restorable, otherwise the reason it doesn't.
+    # It must hold a non-empty master logfile, and any checksum manifests
+    # shipped in it (SHA256SUMS, *.sha256, *.md5) must verify.  Without a
+    # manifest only the structure is checked: reading every file would only
+    # prove it readable, at the cost of the whole backup's I/O.
+    import hashlib
+    import tarfile
+    backup_path = backup["path"]
+    if backup["size"] == 0:
+        return "empty"
+    if not path.isdir(backup_path):
+        if tarfile.is_tarfile(backup_path):
+            try:
+                with tarfile.open(backup_path) as archive:
+                    logfiles = [m for m in archive.getmembers()
+                                if m.isfile() and path.basename(m.name) == BACKUP_MASTER_LOGFILE]
+            except (tarfile.TarError, IOError, OSError, EOFError) as e:
+                return "unreadable archive: %s" % e
+            if not logfiles:
+                return "no %s" % BACKUP_MASTER_LOGFILE
+            if not any(m.size > 0 for m in logfiles):
+                return "empty %s" % BACKUP_MASTER_LOGFILE
+            return None
+        return "not a directory or tar archive"
+
+    files = []
+    for root, _, names in os.walk(backup_path):
+        files.extend(path.join(root, n) for n in names)
+    logfiles = [f for f in files if path.basename(f) == BACKUP_MASTER_LOGFILE]
+    if not logfiles:
+        return "no %s" % BACKUP_MASTER_LOGFILE
+    if not any(path.getsize(f) > 0 for f in logfiles):
+        return "empty %s" % BACKUP_MASTER_LOGFILE
+
+    manifests = [f for f in files if path.basename(f).upper() in ("SHA256SUMS", "MD5SUMS")
+                 or f.endswith(".sha256") or f.endswith(".md5")]
+    for manifest in manifests:
+        algorithm = "md5" if manifest.upper().endswith("MD5") or manifest.upper().endswith("MD5SUMS") else "sha256"
+        with open(manifest) as f:
+            for line in f:
+                fields = line.split(None, 1)
+                if len(fields) != 2:
+                    continue
+                expected, name = fields[0].lower(), fields[1].strip().lstrip("*")
+                target = path.join(path.dirname(manifest), name)
+                if not path.exists(target):
+                    return "missing %s" % name
+                digest = hashlib.new(algorithm)
+                try:
+                    with open(target, 'rb') as data:
+                        for block in iter(lambda: data.read(1 << 20), b""):
+                            digest.update(block)
+                except (IOError, OSError) as e:
+                    return "unreadable %s: %s" % (name, e)
+                if digest.hexdigest() != expected:
+                    return "checksum mismatch for %s" % name
+    return None
+
+def select_backup(backups, name=None):
+    # Of the indexed backups (newest first), the newest that validates (or the
+    # named one, which must validate), or None when none validates.
+    # Candidates are validated newest first; while one is checked, the next
+    # older one is validated alongside, so a bad newest backup costs little
+    # extra time without reading every backup on disk.
+    for backup in backups:
+        print("Backup {} ({}, {:.1f} MB)".format(backup["name"], strftime("%Y-%m-%d %H:%M:%S", gmtime(backup["timestamp"])),
+                                                 backup["size"] / (1024.0 * 1024)))
+    if name:
+        backups = [b for b in backups if b["name"] == name]
+        if not backups:
+            raise Exception("ERROR: Backup %s not found" % name)
+    if not backups:
+        raise Exception("ERROR: No backups found, but master.logfile is corrupt!")
+
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix="backup") as pool:
+        futures = {}
+        for i, backup in enumerate(backups):
+            for j in (i, i + 1):
+                if j < len(backups) and j not in futures:
+                    futures[j] = pool.submit(validate_backup, backups[j])
+            problem = futures[i].result()
+            if problem is None:
+                if i + 1 in futures:
+                    futures[i + 1].cancel()
+                return backup
+            print("Skipping backup {}: {}".format(backup["name"], problem))
+    if name:
+        raise Exception("ERROR: Backup %s is not valid" % name)
+    return None
+
+def restore_datastore(name=None):
+    # restore.sh restores the latest backup on its own, which the install has
+    # always relied on.  That it restores the backup given as its argument
+    # instead is assumed, not confirmed, so the argument is only passed when
+    # another backup was chosen (a bad newest backup, or --restoreBackup).
+    # When no backup validates, restore.sh makes its own choice, as it did
+    # before backups were validated.
+    with span("restore_datastore", kind="wait") as record:
+        backups = index_backups()
+        backup = select_backup(backups, name)
+        command = [cycle_root + "/util/restore.sh"]
+        if backup is None:
+            print("WARNING: No backup passed validation, leaving the choice of backup to restore.sh")
+            record["backup"] = None
+        else:
+            record["backup"] = backup["name"]
+            print("Restoring datastore from {}".format(backup["path"]))
+            if backup is not backups[0]:
+                command.append(backup["path"])
+        started = monotonic()
+        _catch_sys_error(command, stdin_data=b"yes\n")
+        record["restore_duration"] = monotonic() - started
+        print("Restored datastore from {} in {:.1f}s".format(record["backup"] or "restore.sh's choice of backup",
+                                                              record["restore_duration"]))
+    return backup
+
+def datastore_corrupt():
+    return bool(glob.glob(cycle_root + "/data/ads/corrupt*") or glob.glob(cycle_root + "/data/ads/*logfile_failure"))
+
 
+def cs_config_hash():
+    import hashlib
+    sha = hashlib.sha256()
+    for config_file in sorted(glob.glob(cycle_root + "/config/*.properties")):
+        sha.update(config_file.encode("utf-8"))
+        sha.update((_file_digest(config_file) or "").encode("utf-8"))
+    return sha.hexdigest()
+
+
+def read_start_state():
+    return _read_json_state(START_STATE_FILE)
+
+
+def write_start_state(config_hash):
+    _write_json_state(START_STATE_FILE, {"config_hash": config_hash, "started": time()},
+                      "CycleCloud server start record")
+
+
+def cycleserver_responding():
+    target = cycleserver_probe_target()
+    if not target:
+        return False
+    try:
+        await_cycleserver_ready(*target, timeout=0)
+        return True
+    except Exception:
+        return False
+
+
+def await_startup():
     # Retry await_startup in case it takes much longer than expected 
     # (this is common in local testing with limited compute resources)
     max_tries = 3
@@ -350,77 +1955,465 @@ def start_cc():
         except:
             if max_tries >  0:
                 print("Retrying...")
+                note_retry()
             else:
                 raise 
 
 
-def modify_cs_config(options):
+def read_cs_properties():
+    cs_config_file = cycle_root + "/config/cycle_server.properties"
+    properties = {}
+    if not path.exists(cs_config_file):
+        return properties
+    with open(cs_config_file) as cs_config:
+        for line in cs_config:
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith("!") or "=" not in line:
+                continue
+            key, value = line.split("=", 1)
+            properties[key.strip()] = value.strip()
+    return properties
+
+
+def cycleserver_probe_target():
+    # (host, port, use_https) of the configured web server, or None if the
+    # probe cannot be used and we have to fall back to "cycle_server await_startup"
+    try:
+        import ssl
+    except ImportError:
+        return None
+    properties = read_cs_properties()
+    if properties.get("webServerEnableHttps", "").lower() == "true" and properties.get("webServerSslPort"):
+        return ("localhost", int(properties["webServerSslPort"]), True)
+    if properties.get("webServerPort"):
+        return ("localhost", int(properties["webServerPort"]), False)
+    return None
+
+
+def await_cycleserver_ready(host, port, use_https, timeout=STARTUP_TIMEOUT, url_path=READINESS_PATH):
+    # Poll the web server over one reused connection until it answers with a
+    # non-5xx response, backing off exponentially up to the total deadline.
+    import http.client
+    import ssl
+    started = monotonic()
+    deadline = started + timeout
+    backoff = 0.25
+    conn = None
+    with span("await_cycleserver_ready", kind="wait", port=port, https=use_https) as record:
+        record["time_to_first_byte"] = None
+        attempts = 0
+        while True:
+            attempts += 1
+            record["attempts"] = attempts
+            try:
+                if conn is None:
+                    if use_https:
+                        # The server starts out with a self-signed certificate
+                        context = ssl.create_default_context()
+                        context.check_hostname = False
+                        context.verify_mode = ssl.CERT_NONE
+                        conn = http.client.HTTPSConnection(host, port, timeout=10, context=context)
+                    else:
+                        conn = http.client.HTTPConnection(host, port, timeout=10)
+                conn.request("GET", url_path)
+                response = conn.getresponse()
+                response.read()
+                if record["time_to_first_byte"] is None:
+                    record["time_to_first_byte"] = monotonic() - started
+                    print("CycleServer answered after {:.1f}s".format(record["time_to_first_byte"]))
+                if response.status < 500:
+                    record["time_to_ready"] = monotonic() - started
+                    print("CycleServer ready after {:.1f}s ({} attempts)".format(record["time_to_ready"], attempts))
+                    return record["time_to_ready"]
+                if response.getheader("Connection", "").lower() == "close":
+                    conn.close()
+                    conn = None
+            except (OSError, http.client.HTTPException):
+                # Refused while the JVM is still starting, or the connection was dropped
+                if conn is not None:
+                    conn.close()
+                    conn = None
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                if conn is not None:
+                    conn.close()
+                raise Exception("CycleServer did not become ready on port {} within {}s".format(port, timeout))
+            sleep(min(backoff, remaining))
+            backoff = min(backoff * 2, 5.0)
+
+
+@timed_phase
+def modify_cs_config(options, fresh_install=False, tuned=None):
     print("Editing CycleCloud server system properties file")
     # modify the CS config files
     cs_config_file = cycle_root + "/config/cycle_server.properties"
+    if tuned:
+        options = dict(options)
+        options.update(tuned_properties(read_cs_properties(), tuned))
+    changed = apply_properties(cs_config_file, options)
+    if changed:
+        print("Updated {}".format(cs_config_file))
+    else:
+        print("{} already up to date".format(cs_config_file))
 
-    fh, tmp_cs_config_file = mkstemp()
-    with fdopen(fh, 'w') as new_config:
-        with open(cs_config_file) as cs_config:
-            for line in cs_config:
-                if line.startswith('webServerMaxHeapSize='):
-                    new_config.write('webServerMaxHeapSize={}\n'.format(options['webServerMaxHeapSize']))
-                elif line.startswith('webServerPort='):
-                    new_config.write('webServerPort={}\n'.format(options['webServerPort']))
-                elif line.startswith('webServerSslPort='):
-                    new_config.write('webServerSslPort={}\n'.format(options['webServerSslPort']))
-                elif line.startswith('webServerClusterPort'):
-                    new_config.write('webServerClusterPort={}\n'.format(options['webServerClusterPort']))
-                elif line.startswith('webServerEnableHttps='):
-                    new_config.write('webServerEnableHttps={}\n'.format(str(options['webServerEnableHttps']).lower()))
-                elif line.startswith('webServerHostname'):
-                    # This isn't generally a default setting, so set it below
-                    continue
-                else:
-                    new_config.write(line)
+    #Ensure that the files are created by the cycleserver service user
+    if fresh_install:
+        # Nothing has accumulated in the datastore, logs or backups yet, so check the whole tree
+        fix_ownership([cycle_root], cs_user, recursive=True)
+    else:
+        # Only what we touched: on a long-lived server the tree holds gigabytes of data
+        fix_ownership([path.dirname(cs_config_file), cs_config_file], cs_user)
+    return changed
+
+def _property_value(value):
+    if isinstance(value, bool):
+        return str(value).lower()
+    return str(value)
+
+def _property_key(line):
+    stripped = line.strip()
+    if not stripped or stripped[0] in "#!" or "=" not in stripped:
+        return None
+    return stripped.split("=", 1)[0].strip()
+
+def apply_properties(properties_file, overrides):
+    # Apply overrides to a Java properties file in one pass: existing keys are
+    # rewritten in place (every occurrence), keys not yet in the file are
+    # appended, and a value of None removes the key.  Comments, blank lines
+    # and ordering are preserved.  The file is only rewritten (atomically,
+    # keeping its owner and mode) if its content changes.  Returns whether
+    # it changed.
+    with open(properties_file) as f:
+        original = f.read()
+
+    remaining = dict(overrides)
+    lines = []
+    continuation = False
+    for line in original.splitlines(True):
+        if continuation:
+            # Continuation of a replaced/removed multi-line value
+            continuation = line.rstrip("\r\n").endswith("\\")
+            continue
+        key = _property_key(line)
+        if key is not None and key in overrides:
+            continuation = line.rstrip("\r\n").endswith("\\")
+            remaining.pop(key, None)
+            if overrides[key] is not None:
+                lines.append("{}={}\n".format(key, _property_value(overrides[key])))
+            continue
+        lines.append(line)
 
-            if 'webServerHostname' in options and options['webServerHostname']:
-                new_config.write('webServerHostname={}\n'.format(options['webServerHostname']))
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    for key, value in remaining.items():
+        if value is not None:
+            lines.append("{}={}\n".format(key, _property_value(value)))
 
-    remove(cs_config_file)
-    move(tmp_cs_config_file, cs_config_file)
+    content = "".join(lines)
+    if content == original:
+        return False
 
-    #Ensure that the files are created by the cycleserver service user
-    _catch_sys_error(["chown", "-R", "cycle_server.", cycle_root])
+    st = os.stat(properties_file)
+    fh, tmp_file = mkstemp(dir=path.dirname(path.abspath(properties_file)))
+    try:
+        with fdopen(fh, 'w') as f:
+            f.write(content)
+            os.fchmod(f.fileno(), stat.S_IMODE(st.st_mode))
+            if hasattr(os, "fchown") and os.geteuid() == 0:
+                os.fchown(f.fileno(), st.st_uid, st.st_gid)
+        os.replace(tmp_file, properties_file)
+    except BaseException:
+        if path.exists(tmp_file):
+            remove(tmp_file)
+        raise
+    return True
+
+def host_resources():
+    # (total memory in bytes, CPU count) of this VM
+    mem_bytes = None
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemTotal:"):
+                mem_bytes = int(line.split()[1]) * 1024
+                break
+    return mem_bytes, os.cpu_count() or 1
+
+def autotune_properties(mem_bytes, cpus):
+    # CycleServer sizing policy for --autoTune:
+    #   heap:    50% of RAM up to 8 GB, 60% up to 32 GB, 70% above that, rounded
+    #            down to 256 MB, at least 1 GB and below 31 GB (so the JVM keeps
+    #            compressed object pointers); the rest is left to the OS page
+    #            cache, the datastore's off-heap buffers and the CLI/agents.
+    #   GC:      SerialGC on a single CPU, ParallelGC (throughput) for heaps
+    #            under 4 GB, G1 (bounded pauses) for larger heaps.
+    #   threads: 16 web server worker threads per CPU, between 32 and 512.
+    mem_mb = mem_bytes // (1024 * 1024)
+    if mem_mb <= 8 * 1024:
+        fraction = 0.5
+    elif mem_mb <= 32 * 1024:
+        fraction = 0.6
+    else:
+        fraction = 0.7
+    heap_mb = int(mem_mb * fraction) // 256 * 256
+    heap_mb = max(1024, min(heap_mb, 31 * 1024 - 256))
+
+    if cpus < 2:
+        gc = "-XX:+UseSerialGC"
+    elif heap_mb < 4096:
+        gc = "-XX:+UseParallelGC"
+    else:
+        gc = "-XX:+UseG1GC"
+    threads = max(32, min(512, 16 * cpus))
+
+    return {"webServerMaxHeapSize": "{}M".format(heap_mb),
+            AUTOTUNE_JVM_OPTIONS_PROPERTY: gc,
+            AUTOTUNE_THREADS_PROPERTY: threads}
+
+def merge_gc_option(jvm_options, gc):
+    # Swap the collector flag in a JVM options value, keeping every other option
+    options = [o for o in jvm_options.split() if not re.match(r"^-XX:\+Use\w*GC$", o)]
+    return " ".join(options + [gc])
+
+def tuned_properties(existing, tuned):
+    # The tuned GC and thread settings only touch keys the installed
+    # cycle_server.properties already has, so a name this server version
+    # doesn't know is never introduced
+    applied = {}
+    for key, value in sorted(tuned.items()):
+        if key not in existing:
+            print("{} is not in cycle_server.properties, leaving it at the server default".format(key))
+            continue
+        if key == AUTOTUNE_JVM_OPTIONS_PROPERTY:
+            value = merge_gc_option(existing[key], value)
+        applied[key] = value
+    return applied
+
+def load_property_overrides(properties_files=(), properties=()):
+    # Overrides from --propertiesFile (a JSON object, or a .properties file)
+    # and then --property key=value, later ones winning
+    overrides = {}
+    for properties_file in properties_files or ():
+        if properties_file.endswith(".json"):
+            with open(properties_file) as f:
+                overrides.update(json.load(f))
+        else:
+            with open(properties_file) as f:
+                for line in f:
+                    key = _property_key(line)
+                    if key is not None:
+                        overrides[key] = line.split("=", 1)[1].strip()
+    for item in properties or ():
+        if "=" not in item:
+            raise Exception("--property must be key=value: %s" % item)
+        key, value = item.split("=", 1)
+        overrides[key.strip()] = value.strip()
+    return overrides
+
+# The CLI install (a venv built by install.sh) is cached by the SHA-256 of
+# the cyclecloud-cli.zip it was built from.  Each installed build lives in its
+# own <install dir>-<digest> directory, and the install dir is a symlink that
+# is swapped atomically between them.
+CLI_CACHE_DIR = sysroot + "/var/cache/cyclecloud_install/cli"
+CLI_CACHE_KEEP = 3
+
+def _replace_symlink(link, target):
+    tmp_link = "{}.tmp-{}".format(link, os.getpid())
+    if path.lexists(tmp_link):
+        remove(tmp_link)
+    os.symlink(target, tmp_link)
+    os.replace(tmp_link, link)
+
+def _cli_install_dir():
+    # install.sh links the CLI into place: <install dir>/bin/cyclecloud
+    if not path.islink(cyclecloud_cli):
+        return None
+    target = path.normpath(path.join(path.dirname(cyclecloud_cli), os.readlink(cyclecloud_cli)))
+    return path.dirname(path.dirname(target))
+
+def _cli_links(install_dir):
+    # Every link install.sh created next to the CLI (cyclecloud, pogo), relative to install_dir
+    bin_dir = path.dirname(cyclecloud_cli)
+    links = {}
+    for name in listdir(bin_dir):
+        link = path.join(bin_dir, name)
+        if path.islink(link):
+            target = path.normpath(path.join(bin_dir, os.readlink(link)))
+            if target.startswith(install_dir + os.sep):
+                links[name] = path.relpath(target, install_dir)
+    return links
+
+def read_cli_cache(digest=None):
+    # The cache entry for digest, or with no digest the record of the installed build
+    record_file = path.join(CLI_CACHE_DIR, digest, "cli.json") if digest else path.join(CLI_CACHE_DIR, "installed.json")
+    try:
+        with open(record_file) as f:
+            record = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if digest and not path.isdir(path.join(CLI_CACHE_DIR, digest, "tree")):
+        return None
+    return record
+
+def cache_cli_install(digest, install_dir, build_seconds):
+    # Snapshot the freshly built install into the cache (staged, then renamed into place)
+    if not path.isdir(CLI_CACHE_DIR):
+        os.makedirs(CLI_CACHE_DIR)
+    staging = mkdtemp(dir=CLI_CACHE_DIR, prefix=".staging-")
+    try:
+        shutil.copytree(path.realpath(install_dir), path.join(staging, "tree"), symlinks=True)
+        record = {"digest": digest,
+                  "install_dir": install_dir,
+                  "links": _cli_links(install_dir),
+                  "build_seconds": build_seconds,
+                  "created": time()}
+        with open(path.join(staging, "cli.json"), 'w') as f:
+            json.dump(record, f)
+        entry = path.join(CLI_CACHE_DIR, digest)
+        if path.isdir(entry):
+            rmtree(entry)
+        os.rename(staging, entry)
+    except BaseException:
+        rmtree(staging, ignore_errors=True)
+        raise
 
+    entries = [e for e in glob.glob(path.join(CLI_CACHE_DIR, "*")) if path.isdir(e)]
+    entries.sort(key=path.getmtime, reverse=True)
+    for stale in entries[CLI_CACHE_KEEP:]:
+        print("Pruning cached CLI build {}".format(path.basename(stale)))
+        rmtree(stale, ignore_errors=True)
+    return record
+
+def activate_cli_install(record, digest, version_dir=None):
+    # Point the install dir (and the links next to the CLI) at the build for
+    # digest, copying it out of the cache unless version_dir already holds it
+    install_dir = record["install_dir"]
+    if version_dir is None:
+        version_dir = "{}-{}".format(install_dir, digest[:12])
+        if not path.isdir(version_dir):
+            staging = "{}.tmp-{}".format(version_dir, os.getpid())
+            if path.isdir(staging):
+                rmtree(staging)
+            shutil.copytree(path.join(CLI_CACHE_DIR, digest, "tree"), staging, symlinks=True)
+            os.rename(staging, version_dir)
+
+    retired = None
+    if path.isdir(install_dir) and not path.islink(install_dir):
+        # A CLI installed before builds were cached: move it aside first
+        retired = "{}.old-{}".format(install_dir, os.getpid())
+        os.rename(install_dir, retired)
+    _replace_symlink(install_dir, path.basename(version_dir))
+    for name, target in record["links"].items():
+        _replace_symlink(path.join(path.dirname(cyclecloud_cli), name), path.join(install_dir, target))
+
+    # Only the builds this function created: <install dir>-<12 hex digits> and <install dir>.old-<pid>
+    for old in glob.glob(install_dir + "[-.]*"):
+        if (old != version_dir and re.match(r"(-[0-9a-f]{12}|\.old-\d+)$", old[len(install_dir):])
+                and path.isdir(old) and not path.islink(old)):
+            rmtree(old, ignore_errors=True)
+    _atomic_write(path.join(CLI_CACHE_DIR, "installed.json"),
+                  json.dumps({"digest": digest, "install_dir": install_dir}))
+
+@timed_phase
 def install_cc_cli():
     # CLI comes with an install script but that installation is user specific
     # rather than system wide.
     # Downloading and installing pip, then using that to install the CLIs
     # from source.
-    if os.path.exists("/usr/local/bin/cyclecloud"):
-        print("CycleCloud CLI already installed.")
-        return
-
-    print("Unzip and install CLI")
-    chdir(tmpdir)
-    _catch_sys_error(["unzip", "/opt/cycle_server/tools/cyclecloud-cli.zip"])
-    for cli_install_dir in listdir("."):
-        if path.isdir(cli_install_dir) and re.match("cyclecloud-cli-installer", cli_install_dir):
-            print("Found CLI install DIR %s" % cli_install_dir)
-            chdir(cli_install_dir)
-            _catch_sys_error(["./install.sh", "--system"])
+    # Building the venv dominates, so a build is only made for a CLI zip that
+    # hasn't been built before: an unchanged zip is left alone, and one built
+    # earlier (e.g. after a rollback) is restored from the cache.
+    cli_zip = cycle_root + "/tools/cyclecloud-cli.zip"
+    digest = _sha256_file(cli_zip)
+    installed = read_cli_cache() or {}
+    with span("cli_cache", kind="wait", digest=digest[:12]) as report:
+        if installed.get("digest") == digest and os.path.exists(cyclecloud_cli):
+            print("CycleCloud CLI already installed.")
+            report["cache"] = "current"
+            return {"digest": digest, "cache": "current"}
+
+        cached = read_cli_cache(digest)
+        if cached:
+            started = monotonic()
+            activate_cli_install(cached, digest)
+            report["cache"] = "hit"
+            report["saved_seconds"] = max(0.0, cached["build_seconds"] - (monotonic() - started))
+            print("CycleCloud CLI cache hit for {}: restored in {:.1f}s, saving {:.1f}s".format(
+                digest[:12], monotonic() - started, report["saved_seconds"]))
+            return {"digest": digest, "cache": "hit", "saved_seconds": report["saved_seconds"]}
+
+        report["cache"] = "miss"
+        print("CycleCloud CLI cache miss for {}, building".format(digest[:12]))
+        install_dir = installed.get("install_dir")
+        previous = None
+        if install_dir and path.islink(install_dir):
+            # install.sh builds in place at install_dir, so the link has to go
+            # for the build; never build into a build another digest is cached as
+            previous = os.readlink(install_dir)
+            remove(install_dir)
+        started = monotonic()
+        try:
+            # Steps may run concurrently, so never chdir() here: the cwd is process-wide
+            print("Unzip and install CLI")
+            _catch_sys_error(["unzip", cli_zip], cwd=tmpdir)
+            for cli_install_dir in listdir(tmpdir):
+                cli_install_dir = path.join(tmpdir, cli_install_dir)
+                if path.isdir(cli_install_dir) and re.match("cyclecloud-cli-installer", path.basename(cli_install_dir)):
+                    print("Found CLI install DIR %s" % cli_install_dir)
+                    _catch_sys_error(["./install.sh", "--system"], cwd=cli_install_dir)
+        except BaseException:
+            # Put the previous build (still on disk as <install_dir>-<digest>) back
+            # so a failed build doesn't leave the host without a CLI
+            if previous and path.isdir(path.join(path.dirname(install_dir), previous)):
+                print("CLI build failed, restoring the previous CLI build {}".format(previous))
+                if path.isdir(install_dir) and not path.islink(install_dir):
+                    rmtree(install_dir, ignore_errors=True)
+                _replace_symlink(install_dir, previous)
+                previous_record = read_cli_cache(installed["digest"]) if installed.get("digest") else None
+                links = previous_record["links"] if previous_record else _cli_links(install_dir)
+                for name, target in links.items():
+                    _replace_symlink(path.join(path.dirname(cyclecloud_cli), name), path.join(install_dir, target))
+            raise
+        build_seconds = monotonic() - started
+        report["build_seconds"] = build_seconds
+
+        install_dir = _cli_install_dir()
+        if install_dir is None or not path.isdir(install_dir) or path.islink(install_dir):
+            print("CycleCloud CLI at {} is not a linked install, not caching it".format(cyclecloud_cli))
+            return {"digest": digest, "cache": "miss"}
+        record = cache_cli_install(digest, install_dir, build_seconds)
+        # The venv refers to itself by install_dir, which stays valid through the symlink
+        version_dir = "{}-{}".format(install_dir, digest[:12])
+        if path.isdir(version_dir):
+            rmtree(version_dir)
+        os.rename(install_dir, version_dir)
+        activate_cli_install(record, digest, version_dir)
+        print("Cached CycleCloud CLI build {} ({:.1f}s)".format(digest[:12], build_seconds))
+        return {"digest": digest, "cache": "miss", "build_seconds": build_seconds}
 
 
 def already_installed():
     print("Checking for existing Azure CycleCloud install")
-    return os.path.exists("/opt/cycle_server/cycle_server")
-
-def download_install_cc():
-    print("Installing Azure CycleCloud server")
+    return os.path.exists(cs_cmd)
 
+def package_manager():
     if "ubuntu" in str(platform.platform()).lower():
-        _catch_sys_error(["apt", "install", "-y", "cyclecloud8"])
-    else:
-        _catch_sys_error(["yum", "install", "-y", "cyclecloud8"])
-
+        return "apt"
+    return "yum"
+
+def _write_if_changed(file_path, content):
+    # Leaves the file (and its mtime) alone when nothing changed, which is what
+    # lets apt_lists_fresh() skip "apt update" on re-runs
+    if path.exists(file_path):
+        with open(file_path) as f:
+            if f.read() == content:
+                return False
+    with open(file_path, 'w') as f:
+        f.write(content)
+    return True
+
+@timed_phase
 def configure_msft_repos():
-    if "ubuntu" in str(platform.platform()).lower():
+    if package_manager() == "apt":
         configure_msft_apt_repos()
     else:
         configure_msft_yum_repos()
@@ -428,25 +2421,22 @@ def configure_msft_repos():
 def configure_msft_apt_repos():
     print("Configuring Microsoft apt repository for CycleCloud install")
     _catch_sys_error(
-        ["wget", "-q", "-O", "/tmp/microsoft.asc", "https://packages.microsoft.com/keys/microsoft.asc"])
+        ["wget", "-q", "-O", path.join(tmpdir, "microsoft.asc"), "https://packages.microsoft.com/keys/microsoft.asc"])
     _catch_sys_error(
-        ["apt-key", "add", "/tmp/microsoft.asc"])
+        ["apt-key", "add", path.join(tmpdir, "microsoft.asc")])
     
     lsb_release = _catch_sys_error(["lsb_release", "-cs"]).decode("utf-8").strip()
-    with open('/etc/apt/sources.list.d/azure-cli.list', 'w') as f:
-        f.write("deb [arch=amd64] https://packages.microsoft.com/repos/azure-cli/ {} main".format(lsb_release))
-
-    with open('/etc/apt/sources.list.d/cyclecloud.list', 'w') as f:
-        f.write("deb [arch=amd64] https://packages.microsoft.com/repos/cyclecloud {} main".format(lsb_release))
-    _catch_sys_error(["apt", "update", "-y"])
+    _write_if_changed(apt_sources_dir + '/azure-cli.list',
+                      "deb [arch=amd64] https://packages.microsoft.com/repos/azure-cli/ {} main".format(lsb_release))
+    _write_if_changed(apt_sources_dir + '/cyclecloud.list',
+                      "deb [arch=amd64] https://packages.microsoft.com/repos/cyclecloud {} main".format(lsb_release))
 
 def configure_msft_yum_repos():
     print("Configuring Microsoft yum repository for CycleCloud install")
     _catch_sys_error(
         ["rpm", "--import", "https://packages.microsoft.com/keys/microsoft.asc"])
 
-    with open('/etc/yum.repos.d/cyclecloud.repo', 'w') as f:
-        f.write("""\
+    _write_if_changed(yum_repos_dir + '/cyclecloud.repo', """\
 [cyclecloud]
 name=cyclecloud
 baseurl=https://packages.microsoft.com/yumrepos/cyclecloud
@@ -454,8 +2444,7 @@ gpgcheck=1
 gpgkey=https://packages.microsoft.com/keys/microsoft.asc
 """)
 
-    with open('/etc/yum.repos.d/azure-cli.repo', 'w') as f:
-        f.write("""\
+    _write_if_changed(yum_repos_dir + '/azure-cli.repo', """\
 [azure-cli]
 name=Azure CLI
 baseurl=https://packages.microsoft.com/yumrepos/azure-cli
@@ -465,21 +2454,429 @@ gpgkey=https://packages.microsoft.com/keys/microsoft.asc
 """)
 
 
-def install_pre_req():
-    print("Installing pre-requisites for CycleCloud server")
-
+def pre_req_packages(pkg_mgr):
     # not strictly needed, but it's useful to have the AZ CLI
     # Taken from https://docs.microsoft.com/en-us/cli/azure/install-azure-cli-yum?view=azure-cli-latest
-
-    if "ubuntu" in str(platform.platform()).lower():
+    if pkg_mgr == "apt":
+        return [("openjdk-8-jre-headless", None), ("unzip", None), ("python3-venv", None), ("azure-cli", None)]
+    return [("java-1.8.0-openjdk-headless", None), ("azure-cli", None)]
+
+def cyclecloud_packages(pkg_mgr, version=None):
+    return [("cyclecloud8", version or None)]
+
+def package_plan(pkg_mgr, cyclecloud_version=None):
+    # Every package the install needs, in the order the phases used to install them.
+    # Version None means any installed version is acceptable.
+    plan = []
+    for package in pre_req_packages(pkg_mgr) + cyclecloud_packages(pkg_mgr, cyclecloud_version):
+        if package not in plan:
+            plan.append(package)
+    return plan
+
+def installed_package_versions(pkg_mgr, names):
+    if pkg_mgr == "apt":
+        cmd = ["dpkg-query", "-W", "-f=${Package} ${Version} ${db:Status-Status}\\n"] + list(names)
+    else:
+        cmd = ["rpm", "-q", "--qf", "%{NAME} %{VERSION}-%{RELEASE} installed\\n"] + list(names)
+    # Both tools exit non-zero when any of the packages is missing, so don't check the status
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    versions = {}
+    for line in proc.stdout.decode("utf-8", "replace").splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[2] == "installed" and fields[0] in names:
+            versions[fields[0]] = fields[1]
+    return versions
+
+def _version_satisfied(installed, required):
+    if installed is None:
+        return False
+    if not required:
+        return True
+    return installed == required or installed.startswith(required + "-")
+
+def apt_lists_fresh(max_age=APT_LISTS_MAX_AGE):
+    # apt update is only needed if a source list changed after the package lists
+    # were last fetched (apt regenerates pkgcache.bin on every update), or if the
+    # lists are old enough that the mirrors may have dropped the versions they name.
+    stamp = sysroot + "/var/cache/apt/pkgcache.bin"
+    if not path.exists(stamp):
+        return False
+    stamp_mtime = path.getmtime(stamp)
+    source_files = [sysroot + "/etc/apt/sources.list"] + glob.glob(apt_sources_dir + "/*")
+    sources_mtime = max([path.getmtime(f) for f in source_files if path.isfile(f)] or [0])
+    return stamp_mtime > sources_mtime and time() - stamp_mtime < max_age
+
+def _package_spec(pkg_mgr, name, version):
+    if not version:
+        return name
+    return "{}={}".format(name, version) if pkg_mgr == "apt" else "{}-{}".format(name, version)
+
+@timed_phase
+def install_packages(plan, pkg_mgr=None, bundle_dir=None):
+    print("Installing CycleCloud server and pre-requisites")
+    pkg_mgr = pkg_mgr or package_manager()
+
+    installed = installed_package_versions(pkg_mgr, [name for name, _ in plan])
+    missing = [(name, version) for name, version in plan
+               if not _version_satisfied(installed.get(name), version)]
+    for name, version in plan:
+        if (name, version) not in missing:
+            print("Package {} {} already installed, skipping".format(name, installed[name]))
+    if not missing:
+        return []
+
+    specs = [_package_spec(pkg_mgr, name, version) for name, version in missing]
+    if pkg_mgr == "apt":
+        # With a bundle, only its local repository is visible to apt, so nothing touches the network
+        apt_options = bundle_apt_options() if bundle_dir else []
+        if bundle_dir:
+            _catch_sys_error(["apt-get", "update"] + apt_options)
+        elif apt_lists_fresh():
+            print("apt package lists are newer than the source lists, skipping apt update")
+        else:
+            _catch_sys_error(["apt", "update", "-y"])
+        # A single transaction: the lists are read and the dpkg lock taken only once
+        _catch_sys_error(["apt-get" if bundle_dir else "apt", "install", "-y"] + apt_options + specs)
+    elif bundle_dir and not path.isdir(path.join(bundle_dir, "packages", "repodata")):
+        # No repo metadata in the bundle (createrepo wasn't available when it was built),
+        # so hand yum the package files themselves
+        rpms = sorted(glob.glob(path.join(bundle_dir, "packages", "*.rpm")))
+        _catch_sys_error(["yum", "install", "-y", "--disablerepo=*"] + rpms)
+    else:
+        # yum refreshes expired repo metadata itself as part of the transaction
+        yum_options = ["--disablerepo=*", "--enablerepo=" + BUNDLE_REPO_NAME] if bundle_dir else []
+        _catch_sys_error(["yum", "install", "-y"] + yum_options + specs)
+    return specs
+
+
+# Offline bundles: a directory holding the package files for the whole
+# package plan, the Microsoft signing key, the CLI zip and a manifest with
+# the SHA-256 of every file, so air-gapped VMs can install without network.
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_REPO_NAME = "cyclecloud-bundle"
+
+def bundle_apt_options():
+    return ["-o", "Dir::Etc::sourcelist=sources.list.d/{}.list".format(BUNDLE_REPO_NAME),
+            "-o", "Dir::Etc::sourceparts=-",
+            "-o", "APT::Get::List-Cleanup=0"]
+
+def _sha256_file(file_path):
+    import hashlib
+    sha = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+def _write_apt_packages_index(packages_dir):
+    # A flat repository index ("deb file:DIR ./"), built with dpkg-deb so that
+    # dpkg-dev doesn't have to be installed
+    entries = []
+    for deb in sorted(glob.glob(path.join(packages_dir, "*.deb"))):
+        control = check_output(["dpkg-deb", "-f", deb]).decode("utf-8").rstrip("\n")
+        entries.append("{}\nFilename: ./{}\nSize: {}\nSHA256: {}\n".format(
+            control, path.basename(deb), path.getsize(deb), _sha256_file(deb)))
+    packages_file = path.join(packages_dir, "Packages")
+    with open(packages_file, 'w') as f:
+        f.write("\n".join(entries))
+    # Without a Release file apt refuses the repository, even when it is trusted
+    with open(path.join(packages_dir, "Release"), 'w') as f:
+        f.write("Origin: {}\nLabel: {}\nDate: {}\nSHA256:\n {} {} Packages\n".format(
+            BUNDLE_REPO_NAME, BUNDLE_REPO_NAME, strftime("%a, %d %b %Y %H:%M:%S UTC", gmtime()),
+            _sha256_file(packages_file), path.getsize(packages_file)))
+
+def apt_dependency_closure(names):
+    # Every package names can pull in, recursively: the packages apt would
+    # install on a host that has none of them yet.  Virtual packages (shown
+    # as <name>) are provided by packages that are listed themselves.
+    # check_output: _catch_sys_error only keeps the tail of the output
+    output = check_output(["apt-cache", "depends", "--recurse", "--no-recommends", "--no-suggests",
+                           "--no-conflicts", "--no-breaks", "--no-replaces", "--no-enhances"] + list(names))
+    closure = []
+    for line in output.decode("utf-8", "replace").splitlines():
+        if not line or line[0].isspace() or line.startswith("<"):
+            continue
+        name = line.strip()
+        if name.endswith(":any"):
+            name = name[:-len(":any")]
+        if ":" in name:
+            # Another architecture's copy, not installed by this plan
+            continue
+        if name not in closure:
+            closure.append(name)
+    return closure
+
+@timed_phase
+def build_bundle(bundle_dir, plan, pkg_mgr=None):
+    pkg_mgr = pkg_mgr or package_manager()
+    packages_dir = path.join(bundle_dir, "packages")
+    if not path.isdir(packages_dir):
+        os.makedirs(packages_dir)
+    print("Building offline install bundle in {}".format(bundle_dir))
+
+    # The bundle carries the whole dependency closure, including packages this
+    # host already has, so that it installs on a VM with nothing but the base
+    # image.  Build it on a VM created from that same image.
+    specs = [_package_spec(pkg_mgr, name, version) for name, version in plan]
+    if pkg_mgr == "apt":
         _catch_sys_error(["apt", "update", "-y"])
-        _catch_sys_error(["apt", "install", "-y", "openjdk-8-jre-headless"])
-        _catch_sys_error(["apt", "install", "-y", "unzip"])
-        _catch_sys_error(["apt", "install", "-y", "python3-venv"])
-        _catch_sys_error(["apt", "install", "-y", "azure-cli"])
+        planned = set(name for name, _ in plan)
+        downloads = specs + [name for name in apt_dependency_closure([name for name, _ in plan])
+                             if name not in planned]
+        _catch_sys_error(["apt-get", "download"] + downloads, cwd=packages_dir)
+        _write_apt_packages_index(packages_dir)
+    else:
+        if shutil.which("dnf"):
+            _catch_sys_error(["dnf", "download", "--resolve", "--alldeps", "--destdir=" + packages_dir] + specs)
+        elif shutil.which("repotrack"):
+            _catch_sys_error(["repotrack", "-p", packages_dir] + specs)
+        else:
+            raise Exception("Building a bundle needs dnf or repotrack (yum-utils) to download the full "
+                            "dependency closure; yum --downloadonly skips dependencies already installed here")
+        createrepo = shutil.which("createrepo_c") or shutil.which("createrepo")
+        if createrepo:
+            _catch_sys_error([createrepo, packages_dir])
+
+    # The CLI is not bundled separately: install_cc_cli builds it from the
+    # cyclecloud-cli.zip that the bundled cyclecloud8 package installs
+    _catch_sys_error(["wget", "-q", "-O", path.join(bundle_dir, "microsoft.asc"),
+                      "https://packages.microsoft.com/keys/microsoft.asc"])
+
+    files = {}
+    for root, _, names in os.walk(bundle_dir):
+        for name in names:
+            rel_path = path.relpath(path.join(root, name), bundle_dir)
+            if rel_path != "manifest.json":
+                files[rel_path] = _sha256_file(path.join(root, name))
+    cyclecloud_files = [f for f in files if path.basename(f).startswith("cyclecloud8")]
+    manifest = {"format_version": BUNDLE_FORMAT_VERSION,
+                "created": time(),
+                "package_manager": pkg_mgr,
+                "platform": platform.platform(),
+                "plan": plan,
+                "cyclecloud_package": path.basename(cyclecloud_files[0]) if cyclecloud_files else None,
+                "files": files}
+    _atomic_write(path.join(bundle_dir, "manifest.json"), json.dumps(manifest, indent=2, sort_keys=True))
+    print("Bundle contains {} files ({})".format(len(files), manifest["cyclecloud_package"]))
+    return manifest
+
+@timed_phase
+def verify_bundle(bundle_dir, pkg_mgr=None):
+    pkg_mgr = pkg_mgr or package_manager()
+    manifest_file = path.join(bundle_dir, "manifest.json")
+    if not path.exists(manifest_file):
+        raise Exception("No manifest.json in bundle {}".format(bundle_dir))
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if manifest.get("format_version") != BUNDLE_FORMAT_VERSION:
+        raise Exception("Unsupported bundle format {} in {}".format(manifest.get("format_version"), bundle_dir))
+    if manifest.get("package_manager") != pkg_mgr:
+        raise Exception("Bundle {} was built for {}, this host uses {}".format(
+            bundle_dir, manifest.get("package_manager"), pkg_mgr))
+
+    def check(item):
+        rel_path, expected = item
+        file_path = path.join(bundle_dir, rel_path)
+        if not path.exists(file_path):
+            return rel_path, "missing"
+        return rel_path, None if _sha256_file(file_path) == expected else "checksum mismatch"
+
+    # hashlib releases the GIL on large buffers, so the files hash in parallel
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 4) as pool:
+        failures = [(f, err) for f, err in pool.map(check, sorted(manifest["files"].items())) if err]
+    if failures:
+        for rel_path, err in failures:
+            print("Bundle file {}: {}".format(rel_path, err))
+        raise Exception("Bundle {} failed verification ({} bad files)".format(bundle_dir, len(failures)))
+    print("Verified {} bundle files ({})".format(len(manifest["files"]), manifest.get("cyclecloud_package")))
+    return manifest
+
+@timed_phase
+def configure_bundle_repo(bundle_dir, pkg_mgr=None):
+    pkg_mgr = pkg_mgr or package_manager()
+    bundle_dir = path.abspath(bundle_dir)
+    print("Configuring local package repository from bundle {}".format(bundle_dir))
+    packages_dir = path.join(bundle_dir, "packages")
+    if pkg_mgr == "apt":
+        _catch_sys_error(["apt-key", "add", path.join(bundle_dir, "microsoft.asc")])
+        # The bundle's checksums were verified against its manifest, so trust the flat repo
+        _write_if_changed(apt_sources_dir + '/{}.list'.format(BUNDLE_REPO_NAME),
+                          "deb [trusted=yes] file:{} ./\n".format(packages_dir))
     else:
-        _catch_sys_error(["yum", "install", "-y", "java-1.8.0-openjdk-headless"])
-        _catch_sys_error(["yum", "install", "-y", "azure-cli"])
+        _catch_sys_error(["rpm", "--import", path.join(bundle_dir, "microsoft.asc")])
+        _write_if_changed(yum_repos_dir + '/{}.repo'.format(BUNDLE_REPO_NAME), """\
+[{}]
+name=CycleCloud offline bundle
+baseurl=file://{}
+enabled=0
+gpgcheck=1
+gpgkey=file://{}
+""".format(BUNDLE_REPO_NAME, packages_dir, path.join(bundle_dir, "microsoft.asc")))
+
+
+# An install step: func is called with the dict of results of the steps
+# completed so far, and deps names the steps that must complete first.
+# Steps with an inputs callable are journaled: inputs(results) returns the
+# JSON-serializable inputs of the step, and the step is skipped on re-runs
+# while they (and its dependencies) are unchanged and verify(), if given,
+# still returns True.
+Step = namedtuple("Step", ["name", "func", "deps", "inputs", "verify"])
+Step.__new__.__defaults__ = (None, None)
+
+
+class StepFailed(Exception):
+    pass
+
+
+def _json_or_none(value):
+    try:
+        json.dumps(value)
+        return value
+    except (TypeError, ValueError):
+        return None
+
+
+class InstallJournal(object):
+    # Persistent record of the install steps completed so far, keyed by a hash
+    # of each step's inputs.  The journal is kept in memory until the install
+    # tree exists, since on a fresh VM it is created by the package install.
+
+    def __init__(self, journal_file):
+        self.journal_file = journal_file
+        self._lock = threading.Lock()
+        self.steps = {}
+        if path.exists(journal_file):
+            try:
+                with open(journal_file) as f:
+                    self.steps = json.load(f).get("steps", {})
+            except (IOError, OSError, ValueError) as e:
+                print("Ignoring unreadable install journal {}: {}".format(journal_file, e))
+
+    def digest(self, step, results):
+        import hashlib
+        # Only journaled dependencies are chained in: the others (start_cc)
+        # just order the steps, and whatever a step
+        # uses from their results is part of its own inputs
+        with self._lock:
+            deps = dict((d, self.steps[d]["hash"]) for d in step.deps if d in self.steps)
+        material = json.dumps({"inputs": step.inputs(results), "deps": deps}, sort_keys=True, default=str)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def is_current(self, name, digest):
+        with self._lock:
+            return name in self.steps and self.steps[name]["hash"] == digest
+
+    def result(self, name):
+        with self._lock:
+            return self.steps[name].get("result")
+
+    def record(self, name, digest, result, duration):
+        with self._lock:
+            self.steps[name] = {"hash": digest,
+                                "completed": time(),
+                                "duration": duration,
+                                "result": _json_or_none(result)}
+        self.flush()
+
+    def forget(self, name):
+        with self._lock:
+            self.steps.pop(name, None)
+
+    def flush(self):
+        if not path.isdir(path.dirname(self.journal_file)):
+            return
+        with self._lock:
+            content = json.dumps({"version": 1, "steps": self.steps}, indent=2, sort_keys=True)
+        try:
+            _atomic_write(self.journal_file, content, mode=0o600)
+        except (IOError, OSError) as e:
+            print("Unable to write install journal: %s" % e)
+
+
+@contextmanager
+def install_lock(lock_file=LOCK_FILE):
+    # Serialize installer runs: a second run (e.g. the VM agent re-running the
+    # extension) waits for the first, then finds its steps in the journal.
+    import fcntl
+    fd = os.open(lock_file, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            print("Another install is running (lock {}), waiting for it to finish".format(lock_file))
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        os.ftruncate(fd, 0)
+        os.write(fd, "{}\n".format(os.getpid()).encode("utf-8"))
+        yield
+    finally:
+        os.close(fd)
+
+
+def _execute_step(step, results, journal=None, force_steps=()):
+    digest = None
+    if journal is not None and step.inputs is not None:
+        digest = journal.digest(step, results)
+        forced = step.name in force_steps or "all" in force_steps
+        if not forced and journal.is_current(step.name, digest) and (step.verify is None or step.verify()):
+            print("Skipping install step {}: already completed with the same inputs".format(step.name))
+            with span(step.name, kind="phase") as record:
+                record["status"] = "skipped"
+            return journal.result(step.name)
+        # Don't leave a stale record behind if the step fails this time
+        journal.forget(step.name)
+
+    print("Running install step {}".format(step.name))
+    started = monotonic()
+    result = step.func(results)
+    if digest is not None:
+        journal.record(step.name, digest, result, monotonic() - started)
+    return result
+
+
+def run_steps(steps, serial=False, max_workers=4, journal=None, force_steps=()):
+    # Dependencies on steps that are not part of this run are already satisfied.
+    # They stay in step.deps so the journal digest chains in their recorded hash.
+    names = set(step.name for step in steps)
+    results = {}
+
+    if serial:
+        # Declaration order is always a valid topological order
+        for step in steps:
+            results[step.name] = _execute_step(step, results, journal, force_steps)
+        return results
+
+    pending = list(steps)
+    running = {}
+    failures = []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="install-step") as pool:
+        while pending or running:
+            if not failures:
+                ready = [step for step in pending if all(d in results or d not in names for d in step.deps)]
+                for step in ready:
+                    pending.remove(step)
+                    running[pool.submit(_execute_step, step, dict(results), journal, force_steps)] = step
+            if not running:
+                break
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    results[step.name] = future.result()
+                except Exception as e:
+                    # Stop scheduling new steps but let the running ones finish
+                    print("Install step {} failed: {}".format(step.name, e))
+                    failures.append((step, e))
+
+    if failures:
+        skipped = [step.name for step in pending]
+        if skipped:
+            print("Skipped install steps after failure: {}".format(", ".join(skipped)))
+        step, error = failures[0]
+        raise StepFailed("Install step {} failed: {}".format(step.name, error)) from error
+    if pending:
+        raise StepFailed("Unsatisfiable install step dependencies: {}".format(
+            ", ".join(step.name for step in pending)))
+    return results
 
 
 def main():
@@ -522,6 +2919,51 @@ def main():
                         action="store_true",
                         help="Automatically fetch certificate from Let's Encrypt.  (Only suitable for installations with public IP.)")
 
+    parser.add_argument("--letsEncryptDeadline",
+                        dest="letsEncryptDeadline",
+                        type=int,
+                        default=LETSENCRYPT_DEADLINE,
+                        help="Seconds the background Let's Encrypt request keeps retrying")
+
+    parser.add_argument("--letsEncryptWorker",
+                        dest="letsEncryptWorker",
+                        action="store_true",
+                        help=argparse.SUPPRESS)
+
+    parser.add_argument("--warmup",
+                        dest="warmup",
+                        action="store_true",
+                        help="After the install, warm up the server in the background with concurrent requests")
+
+    parser.add_argument("--warmupRequests",
+                        dest="warmupRequests",
+                        metavar="FILE",
+                        help="JSON list of warm-up requests: URL paths or {\"method\", \"path\", \"body\"} "
+                             "(Default: %s)" % ", ".join(WARMUP_REQUESTS))
+
+    parser.add_argument("--warmupTemplates",
+                        dest="warmupTemplates",
+                        metavar="DIR",
+                        help="Import the cluster templates (*.txt) in DIR with the cyclecloud CLI during the warm-up "
+                             "(needs an initialized CLI)")
+
+    parser.add_argument("--warmupRounds",
+                        dest="warmupRounds",
+                        type=int,
+                        default=WARMUP_ROUNDS,
+                        help="Passes over the warm-up requests between the cold and warm measurements")
+
+    parser.add_argument("--warmupConcurrency",
+                        dest="warmupConcurrency",
+                        type=int,
+                        default=WARMUP_CONCURRENCY,
+                        help="Concurrent connections used by the warm-up")
+
+    parser.add_argument("--warmupWorker",
+                        dest="warmupWorker",
+                        action="store_true",
+                        help=argparse.SUPPRESS)
+
     parser.add_argument("--useManagedIdentity",
                         dest="useManagedIdentity",
                         action="store_true",
@@ -554,10 +2996,46 @@ def main():
                         action="store_true",
                         help="Do not attempt to configure a default CycleCloud Account (useful for CycleClouds managing other subscriptions)")
                     
+    parser.add_argument("--accountsManifest",
+                        dest="accountsManifest",
+                        help="JSON file listing additional subscriptions to register as CycleCloud accounts")
+
+    parser.add_argument("--accountConcurrency",
+                        dest="accountConcurrency",
+                        type=int,
+                        default=4,
+                        help="Number of accounts from --accountsManifest to register at a time")
+
+    parser.add_argument("--usersManifest",
+                        dest="usersManifest",
+                        help="JSON file listing local users to create with SSH keys and CycleCloud PublicKey credentials")
+
+    parser.add_argument("--userConcurrency",
+                        dest="userConcurrency",
+                        type=int,
+                        default=8,
+                        help="Number of users from --usersManifest to set up SSH keys for at a time")
+
+    parser.add_argument("--resetPassword",
+                        dest="resetPassword",
+                        action="store_true",
+                        help="Generate and reset the admin password even if the stored CLI credentials "
+                             "still work (only without --password)")
+
+    parser.add_argument("--skipCliInitialize",
+                        dest="skipCliInitialize",
+                        action="store_true",
+                        help="Do not initialize the cyclecloud CLI for root (accounts are created through the REST API)")
+
     parser.add_argument("--webServerMaxHeapSize",
                         dest="webServerMaxHeapSize",
-                        default='4096M',
-                        help="CycleCloud max heap")
+                        help="CycleCloud max heap (Default: %s, or sized from the VM with --autoTune)" % DEFAULT_MAX_HEAP_SIZE)
+
+    parser.add_argument("--autoTune",
+                        dest="autoTune",
+                        action="store_true",
+                        help="Size the CycleCloud heap from the VM's memory and CPUs, and the GC and worker "
+                             "threads where cycle_server.properties already has those settings")
 
     parser.add_argument("--webServerPort",
                         dest="webServerPort",
@@ -579,45 +3057,310 @@ def main():
                         default="",
                         help="Over-ride CycleCloud hostname for cluster/back-end connections")
 
+    parser.add_argument("--imdsEndpoint",
+                        dest="imdsEndpoint",
+                        default=IMDS_ENDPOINT,
+                        help="Azure Instance Metadata Service endpoint (override for local testing)")
+
+    parser.add_argument("--imdsCache",
+                        dest="imdsCache",
+                        default=IMDS_CACHE_FILE,
+                        help="Cache the VM instance metadata in this file (empty to disable)")
+
+    parser.add_argument("--startupTimeout",
+                        dest="startupTimeout",
+                        type=int,
+                        default=STARTUP_TIMEOUT,
+                        help="Seconds to wait for CycleCloud server to respond after starting")
+
+    parser.add_argument("--property",
+                        dest="properties",
+                        action="append",
+                        default=[],
+                        metavar="KEY=VALUE",
+                        help="Set a cycle_server.properties value (repeatable)")
+
+    parser.add_argument("--propertiesFile",
+                        dest="propertiesFiles",
+                        action="append",
+                        default=[],
+                        help="JSON or .properties file of cycle_server.properties values to set (repeatable)")
+
+    parser.add_argument("--forceRestart",
+                        dest="forceRestart",
+                        action="store_true",
+                        help="Restart CycleCloud server even if it is healthy and its configuration is unchanged")
+
+    parser.add_argument("--restoreBackup",
+                        dest="restoreBackup",
+                        metavar="NAME",
+                        help="Restore a corrupt datastore from this backup (in data/backups) instead of the newest valid one")
+
+    parser.add_argument("--cyclecloudVersion",
+                        dest="cyclecloudVersion",
+                        default="",
+                        help="Install this version of the cyclecloud8 package (Default: latest available)")
+
+    parser.add_argument("--upgrade",
+                        dest="upgrade",
+                        action="store_true",
+                        help="Upgrade an existing install to --cyclecloudVersion (Default: latest available), "
+                             "keeping the server down only for the package install and restart and rolling "
+                             "back if the upgraded server doesn't come up")
+
+    parser.add_argument("--buildBundle", "--build-bundle",
+                        dest="buildBundle",
+                        metavar="DIR",
+                        help="Download the packages, signing key and CLI for an offline install into DIR, then exit")
+
+    parser.add_argument("--bundle",
+                        dest="bundle",
+                        metavar="DIR",
+                        help="Install from an offline bundle created with --buildBundle instead of packages.microsoft.com")
+
+    parser.add_argument("--serial",
+                        dest="serial",
+                        action="store_true",
+                        help="Run the install steps one at a time instead of in parallel where possible")
+
+    parser.add_argument("--journal",
+                        dest="journal",
+                        default=JOURNAL_FILE,
+                        help="Record completed install steps in this file so re-runs skip them (empty to disable)")
+
+    parser.add_argument("--forceStep", "--force-step",
+                        dest="forceSteps",
+                        action="append",
+                        default=[],
+                        help="Re-run this install step even if the journal shows it completed (repeatable, or 'all')")
+
+    parser.add_argument("--profile",
+                        dest="profile",
+                        action="store_true",
+                        help="Print a per-phase timing summary (with the critical path) at the end of the run")
+
+    parser.add_argument("--profileOutput",
+                        dest="profileOutput",
+                        default=PROFILE_FILE,
+                        help="Write the JSON install profile to this file, empty to disable (Default: %s)" % PROFILE_FILE)
+
+    parser.add_argument("--profileMetrics",
+                        dest="profileMetrics",
+                        default="",
+                        help="Write install timings as a Prometheus textfile to this file, e.g. in the "
+                             "node exporter's textfile collector directory (Default: not written)")
+
     args = parser.parse_args()
 
     print("Debugging arguments: %s" % args)
 
-    if not already_installed():
-        configure_msft_repos()
-        install_pre_req()
-        download_install_cc()
-        modify_cs_config(options = {'webServerMaxHeapSize': args.webServerMaxHeapSize,
-                                    'webServerPort': args.webServerPort,
-                                    'webServerSslPort': args.webServerSslPort,
-                                    'webServerClusterPort': args.webServerClusterPort,
-                                    'webServerEnableHttps': True,
-                                    'webServerHostname': args.webServerHostname})
-
-    start_cc()
+    if args.letsEncryptWorker:
+        # Detached certificate worker started by letsEncrypt()
+        try:
+            letsencrypt_worker(args.hostname, int(args.webServerPort), args.letsEncryptDeadline)
+        finally:
+            clean_up()
+        return
 
-    install_cc_cli()
+    if args.warmupWorker:
+        # Detached warm-up worker started by warmup(); the password arrives on stdin
+        try:
+            warmup_worker(args.webServerSslPort, args.username, sys.stdin.readline().rstrip("\n"),
+                          load_warmup_requests(args.warmupRequests), args.warmupRounds,
+                          args.warmupConcurrency, args.warmupTemplates)
+        finally:
+            clean_up()
+        return
 
+    run_span = {"name": "install", "kind": "run", "start": time(), "status": "ok"}
+    started = monotonic()
+    try:
+        with install_lock():
+            install(args)
+    except BaseException as e:
+        run_span["status"] = "error"
+        run_span["error"] = "%s: %s" % (type(e).__name__, e)
+        raise
+    finally:
+        run_span["duration"] = monotonic() - started
+        run_span["end"] = run_span["start"] + run_span["duration"]
+        write_install_profile(run_span, args.profileOutput, args.profileMetrics, args.profile)
+
+
+def dryrun_vm_metadata():
+    return {"compute": {
+        "subscriptionId": "1234-50-679890",
+        "location": "dryrun",
+        "resourceGroupName": "dryrun-rg"}}
+
+
+def _file_digest(file_path):
+    if not path.exists(file_path):
+        return None
+    return _sha256_file(file_path)
+
+
+def account_setup_inputs(args, vm_metadata):
+    return {"metadata": vm_metadata["compute"],
+            "username": args.username,
+            "password": args.password,
+            "tenantId": args.tenantId,
+            "applicationId": args.applicationId,
+            "applicationSecret": args.applicationSecret,
+            "azureSovereignCloud": args.azureSovereignCloud,
+            "acceptTerms": args.acceptTerms,
+            "storageAccount": args.storageAccount,
+            "resourceGroup": args.resourceGroup,
+            "useManagedIdentity": args.useManagedIdentity,
+            "noDefaultAccount": args.no_default_account,
+            "skipCliInitialize": args.skipCliInitialize,
+            "resetPassword": args.resetPassword,
+            "accountsManifest": _file_digest(args.accountsManifest) if args.accountsManifest else None,
+            "webServerSslPort": args.webServerSslPort}
+
+
+def install_steps(args):
+    steps = []
+    property_overrides = {}
+    tuned = {}
+    if args.autoTune:
+        mem_bytes, cpus = host_resources()
+        tuned = autotune_properties(mem_bytes, cpus)
+        if args.webServerMaxHeapSize:
+            # An explicit heap size wins over the tuned one
+            tuned["webServerMaxHeapSize"] = args.webServerMaxHeapSize
+        print("Auto-tuned CycleCloud server for {} MB RAM and {} CPUs: {}".format(
+            mem_bytes // (1024 * 1024), cpus,
+            ", ".join("{}={}".format(k, v) for k, v in sorted(tuned.items()))))
+        property_overrides["webServerMaxHeapSize"] = tuned.pop("webServerMaxHeapSize")
+    explicit_overrides = load_property_overrides(args.propertiesFiles, args.properties)
+    property_overrides.update(explicit_overrides)
+    tuned = dict((k, v) for k, v in tuned.items() if k not in explicit_overrides)
+    installed = already_installed()
+    if not installed:
+        plan = package_plan(package_manager(), args.cyclecloudVersion)
+        cs_options = {'webServerMaxHeapSize': args.webServerMaxHeapSize or DEFAULT_MAX_HEAP_SIZE,
+                      'webServerPort': args.webServerPort,
+                      'webServerSslPort': args.webServerSslPort,
+                      'webServerClusterPort': args.webServerClusterPort,
+                      'webServerEnableHttps': True,
+                      # This isn't generally a default setting, so drop it unless requested
+                      'webServerHostname': args.webServerHostname or None}
+        cs_options.update(property_overrides)
+        if args.bundle:
+            steps += [
+                Step("verify_bundle", lambda r: verify_bundle(args.bundle), []),
+                Step("configure_msft_repos", lambda r: configure_bundle_repo(args.bundle), ["verify_bundle"],
+                     inputs=lambda r: {"bundle": r["verify_bundle"]["files"]}),
+            ]
+        else:
+            steps.append(Step("configure_msft_repos", lambda r: configure_msft_repos(), [],
+                              inputs=lambda r: {"package_manager": package_manager()}))
+        steps += [
+            Step("install_packages", lambda r: install_packages(plan, bundle_dir=args.bundle), ["configure_msft_repos"],
+                 inputs=lambda r: {"plan": plan, "bundle": args.bundle}),
+            Step("modify_cs_config", lambda r: modify_cs_config(options = cs_options, fresh_install=True, tuned=tuned),
+                 ["install_packages"],
+                 inputs=lambda r: {"options": cs_options, "tuned": tuned}),
+        ]
+    elif property_overrides:
+        # Explicit overrides are applied to an existing install as well
+        steps.append(Step("modify_cs_config", lambda r: modify_cs_config(options = property_overrides, tuned=tuned), [],
+                          inputs=lambda r: {"options": property_overrides, "tuned": tuned}))
+    if args.upgrade and installed:
+        # Not journaled: a no-op once the installed version is the newest;
+        # the restart in the upgrade window also picks up property overrides
+        steps.append(Step("upgrade_cc", lambda r: upgrade_cc(args.cyclecloudVersion, args.startupTimeout),
+                          ["modify_cs_config"]))
+
+    # The IMDS lookups do not depend on anything installed, so start them at time zero
+    imds = ImdsClient(args.imdsEndpoint)
     if not args.dryrun:
-        vm_metadata = get_vm_metadata()
+        steps.append(Step("get_vm_metadata", lambda r: get_vm_metadata(imds, args.imdsCache), []))
     else:
-        vm_metadata = {"compute": {
-            "subscriptionId": "1234-50-679890",
-            "location": "dryrun",
-            "resourceGroupName": "dryrun-rg"}}
+        steps.append(Step("get_vm_metadata", lambda r: dryrun_vm_metadata(), []))
+
+    account_deps = ["start_cc", "install_cc_cli", "get_vm_metadata"]
+    if args.useManagedIdentity and not args.no_default_account and not args.dryrun:
+        steps.append(Step("prefetch_managed_identity", lambda r: prefetch_managed_identity(imds), []))
+
+    steps += [
+        # Not journaled: start_cc decides for itself whether a restart is needed
+        Step("start_cc", lambda r: start_cc(args.startupTimeout, args.forceRestart, args.restoreBackup),
+             ["modify_cs_config", "upgrade_cc"]),
+        # The CLI ships with the server package but does not need it running,
+        # so unzipping and building the CLI overlaps the server startup
+        Step("install_cc_cli", lambda r: install_cc_cli(), ["install_packages", "upgrade_cc"],
+             inputs=lambda r: {"cli_zip": _file_digest(cycle_root + "/tools/cyclecloud-cli.zip")},
+             verify=lambda: path.exists(cyclecloud_cli)),
+        # The CLI configuration lives outside cycle_root, so a re-run whose
+        # home directory was replaced initializes the CLI again
+        Step("cyclecloud_account_setup", lambda r: account_setup(args, r["get_vm_metadata"], imds), account_deps,
+             inputs=lambda r: account_setup_inputs(args, r["get_vm_metadata"]),
+             verify=lambda: (args.skipCliInitialize or
+                             stored_cli_password(args.username, args.webServerSslPort) is not None)),
+    ]
+
+    if args.usersManifest:
+        # The credentials are imported by the running server
+        users = load_users_manifest(args.usersManifest)
+        steps.append(Step("provision_users", lambda r: provision_users(users, args.userConcurrency), ["start_cc"],
+                          inputs=lambda r: {"users": users}))
+
+    if args.warmup:
+        # Not journaled: the status file written by the background worker records the outcome
+        steps.append(Step("warmup",
+                          lambda r: warmup(args.webServerSslPort, args.username,
+                                           admin_password(args.username, args.password, args.webServerSslPort),
+                                           args.warmupRequests, args.warmupRounds, args.warmupConcurrency,
+                                           args.warmupTemplates),
+                          ["cyclecloud_account_setup"]))
+
+    if args.useLetsEncrypt:
+        # keystore changes the HTTPS listener, so keep it clear of CLI initialization
+        # Not journaled: the status file written by the background worker records the outcome
+        steps.append(Step("letsEncrypt",
+                          lambda r: letsEncrypt(args.hostname, args.webServerPort, args.letsEncryptDeadline),
+                          ["cyclecloud_account_setup"]))
+    return steps
+
 
+def account_setup(args, vm_metadata, imds=None):
     if args.resourceGroup:
         print("CycleCloud created in resource group: %s" % vm_metadata["compute"]["resourceGroupName"])
         print("Cluster resources will be created in resource group: %s" %  args.resourceGroup)
         vm_metadata["compute"]["resourceGroupName"] = args.resourceGroup
 
+    extra_accounts = []
+    if args.accountsManifest:
+        extra_accounts = load_accounts_manifest(args.accountsManifest, vm_metadata, args.tenantId,
+                                                args.applicationId, args.applicationSecret,
+                                                args.useManagedIdentity, args.azureSovereignCloud)
+
     cyclecloud_account_setup(vm_metadata, args.useManagedIdentity, args.tenantId, args.applicationId,
                              args.applicationSecret, args.username, args.azureSovereignCloud,
                              args.acceptTerms, args.password, args.storageAccount, 
-                             args.no_default_account, args.webServerSslPort)
+                             args.no_default_account, args.webServerSslPort,
+                             initialize_cli=not args.skipCliInitialize,
+                             extra_accounts=extra_accounts,
+                             account_concurrency=args.accountConcurrency,
+                             imds=imds,
+                             reset_password=args.resetPassword)
 
-    if args.useLetsEncrypt:
-        letsEncrypt(args.hostname)
+
+def install(args):
+
+    if args.buildBundle:
+        build_bundle(args.buildBundle, package_plan(package_manager(), args.cyclecloudVersion))
+        clean_up()
+        return
+
+    journal = InstallJournal(args.journal) if args.journal else None
+    try:
+        run_steps(install_steps(args), serial=args.serial, journal=journal, force_steps=args.forceSteps)
+    finally:
+        if journal is not None:
+            journal.flush()
 
     #  Create user requires root privileges
     # create_user_credential(args.username, args.publickey)
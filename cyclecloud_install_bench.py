@@ -0,0 +1,1072 @@
+#!/usr/bin/env python3
+# End-to-end benchmark for cyclecloud_install.py that runs without an Azure VM.
+#
+# Every external dependency of the installer is replaced by a fake with
+# configurable latency and failure injection: apt/yum/dpkg/rpm, wget, unzip,
+# the cycle_server script (and a stand-in CycleServer with an HTTPS front end,
+# the accounts REST API and the config/data importer), the cyclecloud CLI and
+# the Instance Metadata Service.  The installer runs unmodified against a
+# scratch root (CYCLECLOUD_INSTALL_ROOT) with the fakes first on PATH, and the
+# install profile of each run gives the per-phase wall time.
+#
+#   python3 cyclecloud_install_bench.py --latencyScale 0.2 --output before.json
+#   python3 cyclecloud_install_bench.py --latencyScale 0.2 --compare before.json
+
+import os
+import argparse
+import getpass
+import json
+import random
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import zipfile
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep, time, monotonic
+
+
+DEFAULT_LATENCIES = {
+    "apt_update": 2.0,    # apt update / yum metadata refresh
+    "package": 1.0,       # per package installed
+    "wget": 0.2,
+    "cs_startup": 5.0,    # CycleServer start until the web server answers
+    "cs_stop": 1.0,
+    "jvm": 1.5,           # every "cycle_server execute|reset_access|keystore" starts a JVM
+    "import": 1.0,        # config/data record file until it is renamed *.imported
+    "restore": 2.0,       # util/restore.sh
+    "cli_install": 2.0,   # the CLI's install.sh
+    "cli": 0.5,           # every cyclecloud CLI invocation
+    "imds": 0.02,         # every IMDS request
+    "api": 0.05,          # every CycleServer REST request
+    "cold_request": 0.5,  # extra for the server's first request, fading out over COLD_REQUESTS
+}
+
+# Requests a freshly started fake server takes to reach full speed
+COLD_REQUESTS = 200
+
+# Probability that a single call fails:
+#   imds         IMDS answers 503 (the installer retries)
+#   imds_json    IMDS answers 200 with a truncated document
+#   package      apt/yum install exits non-zero
+#   execute      "cycle_server execute" exits non-zero
+#   accounts_api /cloud/accounts answers 404 (the installer falls back to the CLI)
+#   upgrade      a cyclecloud8 newer than PACKAGE_VERSION fails to start
+FAILURE_KEYS = ("imds", "imds_json", "package", "execute", "accounts_api", "upgrade")
+
+FAKE_TOOLS = ("apt", "apt-get", "apt-cache", "apt-key", "dpkg-query", "lsb_release", "wget", "unzip", "rpm", "yum")
+
+PACKAGE_VERSION = "8.6.0-3000"
+UPGRADE_VERSION = "8.7.0-3100"
+
+SCENARIOS = ("fresh", "rerun", "corrupt_datastore", "corrupt_newest_backup", "restore_named_backup",
+             "managed_identity_delay", "managed_identity_rerun", "cli_cache_hit", "upgrade", "upgrade_rollback",
+             "container_restart", "warmup")
+
+
+# --- fakes ---------------------------------------------------------------
+#
+# The fakes run as "cyclecloud_install_bench.py fake <tool> ...", configured
+# by the JSON file named in $CYCLECLOUD_BENCH_CONFIG.
+
+def load_config():
+    with open(os.environ["CYCLECLOUD_BENCH_CONFIG"]) as f:
+        return json.load(f)
+
+
+def delay(config, key, count=1):
+    sleep(config["latencies"].get(key, 0) * count)
+
+
+def injected_failure(config, key):
+    return random.random() < config["failures"].get(key, 0)
+
+
+def state_dir(config):
+    return path.join(config["root"], "var/lib/cyclecloud_bench")
+
+
+def cycle_root(config):
+    return path.join(config["root"], "opt/cycle_server")
+
+
+def write_shim(file_path, *fake_args):
+    with open(file_path, 'w') as f:
+        f.write('#!/bin/sh\nexec "{}" "{}" fake {} "$@"\n'.format(
+            sys.executable, path.abspath(__file__), " ".join(fake_args)))
+    os.chmod(file_path, 0o755)
+
+
+def update_json_state(config, name, update):
+    # Read-modify-write of a state file shared by the fake processes
+    import fcntl
+    state_file = path.join(state_dir(config), name)
+    with open(state_file + ".lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(state_file) as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            state = {}
+        result = update(state)
+        with open(state_file + ".tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(state_file + ".tmp", state_file)
+        return result
+
+
+def read_json_state(config, name):
+    try:
+        with open(path.join(state_dir(config), name)) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def read_properties(config):
+    properties = {}
+    properties_file = path.join(cycle_root(config), "config/cycle_server.properties")
+    if path.exists(properties_file):
+        with open(properties_file) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#") and "=" in line:
+                    key, value = line.split("=", 1)
+                    properties[key.strip()] = value.strip()
+    return properties
+
+
+def create_cycle_server_tree(config, version):
+    # What installing the cyclecloud8 package leaves behind
+    root = cycle_root(config)
+    for directory in ("config/data", "tools", "util", "data/ads", "data/backups", "logs"):
+        os.makedirs(path.join(root, directory), exist_ok=True)
+    write_shim(path.join(root, "cycle_server"), "cycle_server")
+    write_shim(path.join(root, "util/restore.sh"), "restore")
+    # Like package configuration files and the datastore, these survive an upgrade
+    properties_file = path.join(root, "config/cycle_server.properties")
+    if not path.exists(properties_file):
+        with open(properties_file, 'w') as f:
+            f.write("# CycleServer properties\n"
+                    "webServerMaxHeapSize=2048M\n"
+                    "webServerPort=8080\n"
+                    "webServerSslPort=8443\n"
+                    "webServerClusterPort=9443\n"
+                    "webServerEnableHttps=false\n")
+    if not path.exists(path.join(root, "data/ads/master.logfile")):
+        with open(path.join(root, "data/ads/master.logfile"), 'w') as f:
+            f.write("datastore\n")
+
+    install_sh = '#!/bin/sh\nexec "{}" "{}" fake cli-install "$@"\n'.format(sys.executable, path.abspath(__file__))
+    with zipfile.ZipFile(path.join(root, "tools/cyclecloud-cli.zip"), 'w') as archive:
+        info = zipfile.ZipInfo("cyclecloud-cli-installer/install.sh")
+        info.external_attr = 0o755 << 16
+        archive.writestr(info, install_sh)
+        archive.writestr("cyclecloud-cli-installer/VERSION", version)
+
+
+def available_version(config, name):
+    return read_json_state(config, "repo.json").get(name, PACKAGE_VERSION)
+
+
+def parse_package_spec(config, spec):
+    for separator in ("=", "-8."):
+        if separator in spec:
+            name, version = spec.split(separator, 1)
+            return name, version if separator == "=" else "8." + version
+    return spec, available_version(config, spec)
+
+
+def fake_package_install(config, args, download_only=False, no_download=False):
+    # --download-only fetches into the package cache; --no-download (yum -C)
+    # installs only what was fetched before and needs no network time
+    packages = [parse_package_spec(config, a) for a in args if not a.startswith("-")]
+    cached = read_json_state(config, "downloads.json")
+    specs = ["{}={}".format(*p) for p in packages]
+    if no_download:
+        installed = read_json_state(config, "packages.json")
+        missing = [spec for spec, p in zip(specs, packages) if spec not in cached and installed.get(p[0]) != p[1]]
+        if missing:
+            print("E: Packages need to be downloaded but downloads are disabled: {}".format(", ".join(missing)))
+            return 100
+    else:
+        delay(config, "package", len([spec for spec in specs if spec not in cached]))
+        if injected_failure(config, "package"):
+            print("E: Failed to fetch packages (injected failure)")
+            return 100
+    if download_only:
+        update_json_state(config, "downloads.json", lambda state: state.update(dict.fromkeys(specs, True)))
+        print("Download complete and in download only mode")
+        return 0
+
+    update_json_state(config, "packages.json", lambda state: state.update(dict(packages)))
+    for name, version in packages:
+        if name == "cyclecloud8":
+            create_cycle_server_tree(config, version)
+        print("Setting up {} ({}) ...".format(name, version))
+    return 0
+
+
+def fake_tool(config, tool, args):
+    if tool in ("apt", "apt-get", "yum"):
+        if args and args[0] == "update":
+            delay(config, "apt_update")
+            stamp = path.join(config["root"], "var/cache/apt/pkgcache.bin")
+            with open(stamp, 'a'):
+                os.utime(stamp, None)
+            return 0
+        if tool == "yum" and args[:1] == ["-C"]:
+            return fake_package_install(config, args[2:], no_download=True)
+        if args and args[0] in ("install", "reinstall", "downgrade"):
+            return fake_package_install(config, args[1:],
+                                        download_only="--download-only" in args or "--downloadonly" in args,
+                                        no_download="--no-download" in args)
+        if tool == "yum" and args[-3:-1] == ["list", "updates"]:
+            name = args[-1]
+            installed = read_json_state(config, "packages.json").get(name)
+            if installed and available_version(config, name) != installed:
+                print("{}.x86_64    {}    cyclecloud".format(name, available_version(config, name)))
+                return 0
+            return 1
+        return 0
+    if tool == "apt-cache":
+        name = args[-1]
+        print("{}:\n  Installed: {}\n  Candidate: {}".format(
+            name, read_json_state(config, "packages.json").get(name, "(none)"), available_version(config, name)))
+        return 0
+    if tool in ("dpkg-query", "rpm"):
+        if tool == "rpm" and args and args[0] == "--import":
+            return 0
+        installed = read_json_state(config, "packages.json")
+        names = [a for a in args if not a.startswith("-") and "%" not in a]
+        for name in names:
+            if name in installed:
+                print("{} {} installed".format(name, installed[name]))
+        return 0 if all(name in installed for name in names) else 1
+    if tool == "wget":
+        delay(config, "wget")
+        with open(args[args.index("-O") + 1], 'w') as f:
+            f.write("-----BEGIN PGP PUBLIC KEY BLOCK-----\n")
+        return 0
+    if tool == "lsb_release":
+        print("focal")
+        return 0
+    if tool == "unzip":
+        with zipfile.ZipFile(args[-1]) as archive:
+            for info in archive.infolist():
+                extracted = archive.extract(info, os.getcwd())
+                mode = info.external_attr >> 16
+                if mode:
+                    os.chmod(extracted, mode)
+        return 0
+    # apt-key and anything else succeed without doing anything
+    return 0
+
+
+def fake_cli_install(config):
+    # Like the real installer: a venv in /usr/local/cyclecloud-cli, linked from /usr/local/bin
+    delay(config, "cli_install")
+    install_dir = path.join(config["root"], "usr/local/cyclecloud-cli")
+    bin_dir = path.join(config["root"], "usr/local/bin")
+    if path.islink(install_dir):
+        os.remove(install_dir)
+    elif path.isdir(install_dir):
+        rmtree(install_dir)
+    site_packages = path.join(install_dir, "lib/python3/site-packages/cyclecloud")
+    os.makedirs(site_packages)
+    os.makedirs(path.join(install_dir, "bin"))
+    for i in range(200):
+        with open(path.join(site_packages, "module_%d.py" % i), 'w') as f:
+            f.write("# generated\n" * 50)
+    for tool in ("cyclecloud", "pogo"):
+        write_shim(path.join(install_dir, "bin", tool), "cyclecloud")
+        link = path.join(bin_dir, tool)
+        if path.lexists(link):
+            os.remove(link)
+        os.symlink(path.join(install_dir, "bin", tool), link)
+    print("CycleCloud CLI installed to {}".format(install_dir))
+    return 0
+
+
+def fake_cyclecloud(config, args):
+    delay(config, "cli")
+    if args[:1] == ["initialize"]:
+        settings = dict(a[2:].split("=", 1) for a in args if a.startswith("--") and "=" in a)
+        cli_config = path.expanduser("~/.cycle/cli.ini")
+        os.makedirs(path.dirname(cli_config), exist_ok=True)
+        with open(cli_config, 'w') as f:
+            f.write("[cyclecloud]\nactive_config = cyclecloud\n\n[config cyclecloud]\n")
+            for key in ("url", "verify-ssl", "username", "password"):
+                f.write("{} = {}\n".format(key.replace("-", "_"), settings.get(key, "")))
+        settings.pop("password", None)
+        update_json_state(config, "cli_config.json", lambda state: state.update(settings))
+        print("Initialization complete.")
+        return 0
+    if args[:2] == ["account", "show"]:
+        name = args[2]
+        if name in read_json_state(config, "accounts.json"):
+            print("Account: {}\nCredentials: {}".format(name, name))
+        else:
+            print("No account named {}".format(name))
+        return 0
+    if args[:2] == ["account", "create"]:
+        with open(args[args.index("-f") + 1]) as f:
+            account = json.load(f)
+        update_json_state(config, "accounts.json", lambda state: state.update({account["Name"]: account}))
+        print("Created account {}".format(account["Name"]))
+        return 0
+    if args[:1] == ["import_template"]:
+        if not path.exists(path.expanduser("~/.cycle/cli.ini")):
+            print("CycleCloud CLI is not initialized")
+            return 1
+        template = args[args.index("-f") + 1]
+        with open(template) as f:
+            names = [line.strip()[len("[cluster"):-1].strip() for line in f if line.strip().startswith("[cluster ")]
+        if len(names) != 1:
+            print("Expected one cluster in {}, found {}".format(template, len(names)))
+            return 1
+        update_json_state(config, "templates.json", lambda state: state.update({names[0]: template}))
+        print("Imported cluster {}".format(names[0]))
+        return 0
+    print("Unsupported cyclecloud command: {}".format(" ".join(args)))
+    return 1
+
+
+def server_pid(config):
+    try:
+        with open(path.join(state_dir(config), "server.pid")) as f:
+            pid = int(f.read().strip())
+        os.kill(pid, 0)
+        return pid
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def stop_server(config):
+    pid = server_pid(config)
+    if pid is None:
+        return False
+    os.kill(pid, signal.SIGTERM)
+    deadline = monotonic() + 10
+    while monotonic() < deadline and server_pid(config) == pid:
+        sleep(0.05)
+    return True
+
+
+def server_ports(properties):
+    https = properties.get("webServerEnableHttps", "").lower() == "true"
+    return int(properties.get("webServerPort", 8080)), int(properties.get("webServerSslPort", 8443)), https
+
+
+def fake_cycle_server(config, args):
+    command = args[0] if args else ""
+    if command == "start":
+        if server_pid(config) is None:
+            log = open(path.join(cycle_root(config), "logs/cycle_server.log"), 'a')
+            server = subprocess.Popen([sys.executable, path.abspath(__file__), "fake", "server"],
+                                      stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                      start_new_session=True)
+            with open(path.join(state_dir(config), "server.pid"), 'w') as f:
+                f.write(str(server.pid))
+        print("CycleServer starting")
+        return 0
+    if command == "stop":
+        if stop_server(config):
+            delay(config, "cs_stop")
+        print("CycleServer stopped")
+        return 0
+    if command == "await_startup":
+        http_port, _, _ = server_ports(read_properties(config))
+        deadline = monotonic() + 600
+        while monotonic() < deadline:
+            try:
+                socket.create_connection(("localhost", http_port), timeout=1).close()
+                return 0
+            except OSError:
+                sleep(0.2)
+        return 1
+    if command in ("execute", "reset_access", "keystore"):
+        delay(config, "jvm")
+        if command == "reset_access":
+            sys.stdin.read()
+            password = "Bench" + str(random.randint(10 ** 8, 10 ** 9))
+            update_json_state(config, "users.json", lambda state: state.update({args[1]: password}))
+            print("Access for {} reset. New password: {}".format(args[1], password))
+            return 0
+        if command == "execute":
+            if injected_failure(config, "execute"):
+                print("Datastore error (injected failure)")
+                return 1
+            with open(path.join(state_dir(config), "executed.log"), 'a') as f:
+                f.write(args[1] + "\n")
+        return 0
+    print("Unsupported cycle_server command: {}".format(command))
+    return 1
+
+
+def fake_restore(config, args):
+    # Restores the backup given, or on its own the latest one by name
+    sys.stdin.read()
+    delay(config, "restore")
+    if args:
+        backup = args[0]
+    else:
+        backups = sorted(os.listdir(path.join(cycle_root(config), "data/backups")))
+        if not backups:
+            print("No backups to restore")
+            return 1
+        backup = backups[-1]
+    ads = path.join(cycle_root(config), "data/ads")
+    for name in os.listdir(ads):
+        if name.startswith("corrupt") or name.endswith("logfile_failure"):
+            os.remove(path.join(ads, name))
+    update_json_state(config, "restored.json", lambda state: state.update({"backup": path.basename(backup)}))
+    print("Restored datastore from {}".format(backup))
+    return 0
+
+
+def run_fake_server(config):
+    # Stand-in CycleServer: after the startup latency, serve the front end
+    # (HTTP, plus HTTPS when enabled) with the accounts API, and import the
+    # record files dropped into config/data.
+    import ssl
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    delay(config, "cs_startup")
+    version = read_json_state(config, "packages.json").get("cyclecloud8")
+    if version != PACKAGE_VERSION and injected_failure(config, "upgrade"):
+        print("CycleServer {} failed to start (injected failure)".format(version))
+        return 1
+    properties = read_properties(config)
+    http_port, https_port, https = server_ports(properties)
+    data_dir = path.join(cycle_root(config), "config/data")
+    served = [0]
+    served_lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def handle_one_request(self):
+            # Class loading and JIT: early requests are slower
+            with served_lock:
+                served[0] += 1
+                warmth = min(1.0, served[0] / float(COLD_REQUESTS))
+            sleep(config["latencies"].get("cold_request", 0) * (1.0 - warmth))
+            BaseHTTPRequestHandler.handle_one_request(self)
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def reply(self, status, body, content_type="application/json"):
+            data = json.dumps(body).encode("utf-8") if content_type == "application/json" else body
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def authorized(self):
+            import base64
+            try:
+                username, password = base64.b64decode(
+                    self.headers.get("Authorization", "").split(" ", 1)[1]).decode("utf-8").split(":", 1)
+            except (IndexError, ValueError):
+                return False
+            return read_json_state(config, "users.json").get(username) == password
+
+        def accounts_api(self):
+            delay(config, "api")
+            if not self.authorized():
+                self.reply(401, {"error": "unauthorized"})
+                return False
+            if injected_failure(config, "accounts_api"):
+                self.reply(404, {"error": "not found"})
+                return False
+            return True
+
+        def do_GET(self):
+            if self.path.startswith("/cloud/accounts"):
+                if self.accounts_api():
+                    self.reply(200, list(read_json_state(config, "accounts.json").values()))
+            else:
+                self.reply(200, b"<html>CycleCloud</html>", "text/html")
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path.startswith("/cloud/accounts"):
+                if self.accounts_api():
+                    account = json.loads(body.decode("utf-8"))
+                    update_json_state(config, "accounts.json", lambda state: state.update({account["Name"]: account}))
+                    self.reply(201, account)
+            else:
+                self.reply(404, {"error": "not found"})
+
+    servers = [ThreadingHTTPServer(("localhost", http_port), Handler)]
+    if https:
+        secure = ThreadingHTTPServer(("localhost", https_port), Handler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(config["cert"], config["key"])
+        secure.socket = context.wrap_socket(secure.socket, server_side=True)
+        servers.append(secure)
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("CycleServer listening on {}".format(", ".join(str(s.server_address[1]) for s in servers)))
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+    first_seen = {}
+    while path.isdir(data_dir):
+        for name in os.listdir(data_dir):
+            if not name.endswith(".json"):
+                continue
+            seen = first_seen.setdefault(name, monotonic())
+            if monotonic() - seen >= config["latencies"].get("import", 0):
+                import_records(config, path.join(data_dir, name))
+                os.rename(path.join(data_dir, name), path.join(data_dir, name + ".imported"))
+                first_seen.pop(name)
+        sleep(0.05)
+    # The benchmark root was removed underneath us
+    return 0
+
+
+def import_records(config, record_file):
+    # Only the login users matter to the fakes
+    try:
+        with open(record_file) as f:
+            records = json.load(f)
+    except (IOError, OSError, ValueError):
+        return
+    users = dict((r["Name"], r["RawPassword"]) for r in records if isinstance(r, dict) and
+                 r.get("AdType") == "AuthenticatedUser" and "RawPassword" in r)
+    if users:
+        update_json_state(config, "users.json", lambda state: state.update(users))
+
+
+def fake_main(argv):
+    config = load_config()
+    tool, args = argv[0], argv[1:]
+    if tool == "cycle_server":
+        return fake_cycle_server(config, args)
+    if tool == "server":
+        return run_fake_server(config)
+    if tool == "restore":
+        return fake_restore(config, args)
+    if tool == "cyclecloud":
+        return fake_cyclecloud(config, args)
+    if tool == "cli-install":
+        return fake_cli_install(config)
+    return fake_tool(config, tool, args)
+
+
+class FakeImds(object):
+    # Instance Metadata Service on a local port.  The managed identity token
+    # is refused with a 400 (as Azure does while the identity is still being
+    # assigned) until identity_delay seconds after start().
+
+    def __init__(self, config, identity_delay=0):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        imds = self
+        self.identity_delay = identity_delay
+        self.started = monotonic()
+        self.requests = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, fmt, *args):
+                pass
+
+            def reply(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                if status == 200 and injected_failure(config, "imds_json"):
+                    data = data[:len(data) // 2]
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                imds.requests += 1
+                delay(config, "imds")
+                if self.headers.get("Metadata") != "true":
+                    self.reply(400, {"error": "Bad request. Required metadata header not specified"})
+                elif injected_failure(config, "imds"):
+                    self.reply(503, {"error": "service unavailable (injected failure)"})
+                elif self.path.startswith("/metadata/instance"):
+                    self.reply(200, {"compute": {"subscriptionId": "00000000-0000-0000-0000-000000000000",
+                                                 "location": "benchregion",
+                                                 "resourceGroupName": "bench-rg",
+                                                 "name": "cyclecloud-bench",
+                                                 "vmId": "00000000-0000-0000-0000-000000000001"}})
+                elif self.path.startswith("/metadata/identity/oauth2/token"):
+                    if monotonic() - imds.started < imds.identity_delay:
+                        self.reply(400, {"error": "invalid_request", "error_description": "Identity not found"})
+                    else:
+                        self.reply(200, {"access_token": "bench-token", "token_type": "Bearer",
+                                         "expires_in": "3599", "expires_on": str(int(time()) + 3599),
+                                         "resource": "https://management.azure.com/"})
+                else:
+                    self.reply(404, {"error": "not found"})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.endpoint = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def start(self):
+        self.started = monotonic()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# --- benchmark -----------------------------------------------------------
+
+def free_port():
+    s = socket.socket()
+    s.bind(("localhost", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def create_certificate(work_dir):
+    cert, key = path.join(work_dir, "server.pem"), path.join(work_dir, "server.key")
+    subprocess.check_call(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "2",
+                           "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def prepare_root(scenario_dir, base_config):
+    # A scratch system root with the fake tools on PATH, as a fresh VM would look
+    root = path.join(scenario_dir, "root")
+    for directory in ("etc/apt/sources.list.d", "etc/yum.repos.d", "var/lock", "var/cache/apt",
+                      "var/lib/cyclecloud_bench", "usr/local/bin", "opt", "bin", "root"):
+        os.makedirs(path.join(root, directory), exist_ok=True)
+    with open(path.join(root, "etc/apt/sources.list"), 'w') as f:
+        f.write("deb http://archive.ubuntu.com/ubuntu focal main\n")
+    for tool in FAKE_TOOLS:
+        write_shim(path.join(root, "bin", tool), tool)
+    config_file = path.join(scenario_dir, "bench_config.json")
+    config = dict(base_config, root=root, config_file=config_file)
+    save_config(config)
+    env = dict(os.environ,
+               PATH=path.join(root, "bin") + os.pathsep + os.environ.get("PATH", ""),
+               CYCLECLOUD_INSTALL_ROOT=root,
+               CYCLECLOUD_SERVICE_USER=getpass.getuser(),
+               HOME=path.join(root, "root"),
+               CYCLECLOUD_BENCH_CONFIG=config_file)
+    return config, env
+
+
+def save_config(config):
+    with open(config["config_file"], 'w') as f:
+        json.dump(config, f, indent=2)
+
+
+def publish_upgrade(config):
+    # A newer cyclecloud8 in the repository, while the server holds some data
+    update_json_state(config, "repo.json", lambda state: state.update({"cyclecloud8": UPGRADE_VERSION}))
+    ads = path.join(cycle_root(config), "data/ads")
+    for i in range(50):
+        with open(path.join(ads, "segment_%d.dat" % i), 'w') as f:
+            f.write("record\n" * 20000)
+
+
+def publish_broken_upgrade(config):
+    publish_upgrade(config)
+    config["failures"] = dict(config["failures"], upgrade=1.0)
+    save_config(config)
+
+
+def write_backup(config, name, logfile_lines=1000):
+    backup = path.join(cycle_root(config), "data/backups", name)
+    os.makedirs(backup, exist_ok=True)
+    with open(path.join(backup, "master.logfile"), 'w') as f:
+        f.write("datastore\n" * logfile_lines)
+
+
+def corrupt_datastore(config):
+    # A corrupt master log plus one good backup for the installer to restore
+    with open(path.join(cycle_root(config), "data/ads/corrupt_master.logfile"), 'w') as f:
+        f.write("corrupt\n")
+    write_backup(config, "backup-2024-01-01_00-00-00")
+    config["expect_restore"] = "backup-2024-01-01_00-00-00"
+
+
+def corrupt_newest_backup(config):
+    # The newest backup was cut short (an empty master log), so the older one is restored
+    corrupt_datastore(config)
+    write_backup(config, "backup-2024-01-02_00-00-00", logfile_lines=0)
+    with open(path.join(cycle_root(config), "data/backups/backup-2024-01-02_00-00-00/other.dat"), 'w') as f:
+        f.write("data\n")
+
+
+def two_good_backups(config):
+    # --restoreBackup picks the older of two good backups
+    corrupt_datastore(config)
+    write_backup(config, "backup-2024-01-02_00-00-00")
+
+
+def restart_container(config):
+    # The container comes back with the server stopped and without the install
+    # journal, while the datastore and the CLI configuration persist
+    stop_server(config)
+    os.remove(path.join(cycle_root(config), "install_journal.json"))
+
+
+def remove_cli(config):
+    # The CLI is gone (or was rolled back) while its build is still cached
+    cli = path.join(config["root"], "usr/local/bin/cyclecloud")
+    install_dir = path.dirname(path.dirname(path.join(path.dirname(cli), os.readlink(cli))))
+    rmtree(path.realpath(install_dir))
+    os.remove(cli)
+
+
+def scenario_runs(name, identity_delay, startup_timeout):
+    # (label, extra installer arguments, hook run before the install, IMDS identity delay,
+    #  measured, expected to fail)
+    if name == "fresh":
+        return [("install", [], None, 0, True, False)]
+    if name == "rerun":
+        return [("install", [], None, 0, False, False),
+                ("rerun", [], None, 0, True, False)]
+    if name == "corrupt_datastore":
+        return [("install", [], None, 0, False, False),
+                ("restore", [], corrupt_datastore, 0, True, False)]
+    if name == "corrupt_newest_backup":
+        return [("install", [], None, 0, False, False),
+                ("restore", [], corrupt_newest_backup, 0, True, False)]
+    if name == "restore_named_backup":
+        return [("install", [], None, 0, False, False),
+                ("restore", ["--restoreBackup", "backup-2024-01-01_00-00-00"], two_good_backups, 0, True, False)]
+    if name == "cli_cache_hit":
+        return [("install", [], None, 0, False, False),
+                ("reinstall", [], remove_cli, 0, True, False)]
+    if name == "managed_identity_delay":
+        return [("install", ["--useManagedIdentity"], None, identity_delay, True, False)]
+    if name == "managed_identity_rerun":
+        # The account exists, so the re-run must not wait for the identity
+        return [("install", ["--useManagedIdentity"], None, 0, False, False),
+                ("rerun", ["--useManagedIdentity"], None, identity_delay, True, False)]
+    if name == "warmup":
+        return [("install", ["--warmup"], None, 0, True, False)]
+    if name == "container_restart":
+        # A generated admin password, as in the container image
+        return [("install", ["--password", ""], None, 0, False, False),
+                ("restart", ["--password", ""], restart_container, 0, True, False)]
+    upgrade_args = ["--upgrade", "--startupTimeout", str(startup_timeout)]
+    if name == "upgrade":
+        return [("install", [], None, 0, False, False),
+                ("upgrade", upgrade_args, publish_upgrade, 0, True, False)]
+    if name == "upgrade_rollback":
+        # The upgraded server never comes up, so the installer rolls back and fails
+        return [("install", [], None, 0, False, False),
+                ("upgrade", upgrade_args, publish_broken_upgrade, 0, True, True)]
+    raise ValueError("Unknown scenario %s" % name)
+
+
+def top_level_phases(profile):
+    # The install steps (their nested spans are accounted within them)
+    phases = {}
+    for s in profile.get("phases", []):
+        if s.get("parent") is None:
+            phases[s["name"]] = phases.get(s["name"], 0.0) + (s.get("duration") or 0.0)
+    return phases
+
+
+def run_installer(installer, config, env, run_dir, extra_args, imds, installer_args, expect_failure=False):
+    os.makedirs(run_dir, exist_ok=True)
+    profile_file = path.join(run_dir, "profile.json")
+    cmd = [sys.executable, installer,
+           "--acceptTerms",
+           "--username", "cc_admin",
+           "--password", "Bench-Passw0rd-1",
+           "--tenantId", "bench-tenant",
+           "--applicationId", "bench-app",
+           "--applicationSecret", "bench-secret",
+           "--storageAccount", "benchlocker",
+           "--webServerPort", str(config["ports"]["http"]),
+           "--webServerSslPort", str(config["ports"]["https"]),
+           "--webServerClusterPort", str(config["ports"]["cluster"]),
+           "--imdsEndpoint", imds.endpoint,
+           "--imdsCache", "",
+           "--profileOutput", profile_file,
+           "--profileMetrics", ""] + list(extra_args) + list(installer_args)
+    started = monotonic()
+    with open(path.join(run_dir, "install.log"), 'w') as log:
+        returncode = subprocess.call(cmd, env=env, stdout=log, stderr=subprocess.STDOUT, cwd=run_dir)
+    wall = monotonic() - started
+    try:
+        with open(profile_file) as f:
+            profile = json.load(f)
+    except (IOError, OSError, ValueError):
+        profile = {}
+    run = profile.get("run", {})
+    windows = [s for s in profile.get("spans", []) if s.get("name") == "upgrade_window"]
+    if (returncode != 0) == expect_failure:
+        status = "ok"
+    else:
+        status = "failed (exit %d)" % returncode if returncode else "succeeded, expected a failure"
+    return {"status": status,
+            "wall": wall,
+            "install": run.get("duration"),
+            "phases": top_level_phases(profile),
+            "critical_path": profile.get("critical_path", []),
+            "retries": sum(s.get("retries", 0) for s in profile.get("spans", [])),
+            "identity_available": (profile.get("managed_identity") or {}).get("available_after"),
+            "downtime": sum(s.get("downtime") or 0.0 for s in windows) if windows else None,
+            "imds_requests": imds.requests,
+            "log": path.join(run_dir, "install.log")}
+
+
+def await_warmup(config, timeout=300):
+    # The warm-up worker outlives the installer; wait for its measurements
+    status_file = path.join(cycle_root(config), "install_warmup_status.json")
+    deadline = monotonic() + timeout
+    while path.exists(status_file) and monotonic() < deadline:
+        with open(status_file) as f:
+            status = json.load(f)
+        if status.get("state") not in ("pending", "running"):
+            return status
+        sleep(0.2)
+    return None
+
+
+def run_scenario(name, args, base_config, installer, work_dir, repeat_index):
+    scenario_dir = path.join(work_dir, "{}-{}".format(name, repeat_index))
+    os.makedirs(scenario_dir)
+    base_config = dict(base_config, ports={"http": free_port(), "https": free_port(), "cluster": free_port()})
+    config, env = prepare_root(scenario_dir, base_config)
+    measured = None
+    try:
+        # Long enough for a start at the simulated latency, short enough to reach a rollback quickly
+        startup_timeout = int(config["latencies"].get("cs_startup", 0) * 2) + 10
+        runs = scenario_runs(name, args.identityDelay, startup_timeout)
+        for label, extra_args, hook, identity_delay, is_measured, expect_failure in runs:
+            if hook:
+                hook(config)
+            imds = FakeImds(config, identity_delay)
+            imds.start()
+            try:
+                result = run_installer(installer, config, env, path.join(scenario_dir, label),
+                                       extra_args, imds, args.installerArgs, expect_failure)
+            finally:
+                imds.stop()
+            result["warmup"] = await_warmup(config)
+            restored = read_json_state(config, "restored.json").get("backup")
+            if config.get("expect_restore") and result["status"] == "ok" and restored != config["expect_restore"]:
+                result["status"] = "restored {} instead of {}".format(restored, config["expect_restore"])
+            print("  {:<24} {:<8} {:>8.1f}s  {}".format(name, label, result["wall"], result["status"]))
+            if result["status"] != "ok" or is_measured:
+                measured = result
+            if result["status"] != "ok":
+                print("    see {}".format(result["log"]))
+                break
+    finally:
+        stop_server(config)
+    return measured
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def warmup_summary(runs):
+    # Median request latency percentiles before and after the warm-up
+    summary = {}
+    for when in ("before", "after"):
+        for key in ("p50", "p99"):
+            values = [r["warmup"][when][key] for r in runs
+                      if key in ((r.get("warmup") or {}).get(when) or {})]
+            if values:
+                summary["{}_{}".format(when, key)] = median(values)
+    return summary or None
+
+
+def summarize(runs):
+    failed = [r for r in runs if r["status"] != "ok"]
+    phase_names = sorted(set(p for r in runs for p in r["phases"]))
+    return {"status": failed[0]["status"] if failed else "ok",
+            "wall": median([r["wall"] for r in runs]),
+            "install": median([r["install"] for r in runs if r["install"] is not None]),
+            "phases": dict((p, median([r["phases"][p] for r in runs if p in r["phases"]])) for p in phase_names),
+            "critical_path": runs[-1]["critical_path"],
+            "identity_available": median([r["identity_available"] for r in runs
+                                          if r.get("identity_available") is not None]),
+            "downtime": median([r["downtime"] for r in runs if r.get("downtime") is not None]),
+            "warmup": warmup_summary(runs),
+            "runs": runs}
+
+
+def format_delta(current, baseline):
+    if current is None or baseline is None:
+        return ""
+    delta = current - baseline
+    percent = " ({:+.0f}%)".format(100.0 * delta / baseline) if baseline > 0.05 else ""
+    return "{:+.2f}s{}".format(delta, percent)
+
+
+def print_report(results, baseline=None):
+    baseline = (baseline or {}).get("scenarios", {})
+    print("")
+    for name, summary in results.items():
+        before = baseline.get(name, {})
+        print("{}: {} wall {:.2f}s (installer {:.2f}s) {}".format(
+            name, summary["status"], summary["wall"], summary["install"] or 0,
+            format_delta(summary["wall"], before.get("wall"))))
+        if summary.get("identity_available") is not None:
+            print("    managed identity available after {:.2f}s {}".format(
+                summary["identity_available"],
+                format_delta(summary["identity_available"], before.get("identity_available"))))
+        warm = summary.get("warmup") or {}
+        if "after_p50" in warm:
+            print("    warm-up request latency p50 {:.3f}s -> {:.3f}s, p99 {:.3f}s -> {:.3f}s".format(
+                warm["before_p50"], warm["after_p50"], warm["before_p99"], warm["after_p99"]))
+        if summary.get("downtime") is not None:
+            print("    upgrade downtime {:.2f}s {}".format(
+                summary["downtime"], format_delta(summary["downtime"], before.get("downtime"))))
+        critical = set(summary["critical_path"])
+        for phase, duration in sorted(summary["phases"].items(), key=lambda p: -p[1]):
+            print("    {} {:<28} {:>8.2f}s {}".format("*" if phase in critical else " ", phase, duration,
+                                                     format_delta(duration, before.get("phases", {}).get(phase))))
+    print("(* = critical path; median of runs; deltas against --compare baseline)")
+
+
+def parse_knobs(items, valid_keys, flag):
+    knobs = {}
+    for item in items:
+        if "=" not in item:
+            raise SystemExit("%s must be key=value: %s" % (flag, item))
+        key, value = item.split("=", 1)
+        if key not in valid_keys:
+            raise SystemExit("Unknown %s key %s (one of %s)" % (flag, key, ", ".join(sorted(valid_keys))))
+        knobs[key] = float(value)
+    return knobs
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == "fake":
+        sys.exit(fake_main(sys.argv[2:]))
+
+    parser = argparse.ArgumentParser(description="Benchmark cyclecloud_install.py against simulated dependencies")
+
+    parser.add_argument("--scenario",
+                        dest="scenarios",
+                        action="append",
+                        choices=SCENARIOS,
+                        help="Scenario to run (repeatable, Default: all)")
+
+    parser.add_argument("--repeat",
+                        dest="repeat",
+                        type=int,
+                        default=1,
+                        help="Run each scenario this many times and report the median")
+
+    parser.add_argument("--latencyScale",
+                        dest="latencyScale",
+                        type=float,
+                        default=1.0,
+                        help="Multiply every simulated latency by this factor")
+
+    parser.add_argument("--latency",
+                        dest="latencies",
+                        action="append",
+                        default=[],
+                        metavar="KEY=SECONDS",
+                        help="Override a simulated latency (repeatable): %s" % ", ".join(sorted(DEFAULT_LATENCIES)))
+
+    parser.add_argument("--failureRate",
+                        dest="failureRates",
+                        action="append",
+                        default=[],
+                        metavar="KEY=RATE",
+                        help="Probability of an injected failure per call (repeatable): %s" % ", ".join(FAILURE_KEYS))
+
+    parser.add_argument("--identityDelay",
+                        dest="identityDelay",
+                        type=float,
+                        default=10.0,
+                        help="Seconds before the managed identity becomes available (managed_identity_delay scenario)")
+
+    parser.add_argument("--installer",
+                        dest="installer",
+                        default=path.join(path.dirname(path.abspath(__file__)), "cyclecloud_install.py"),
+                        help="Installer script to benchmark")
+
+    parser.add_argument("--installerArg",
+                        dest="installerArgs",
+                        action="append",
+                        default=[],
+                        help="Extra argument passed to every installer run (repeatable, e.g. --installerArg=--serial)")
+
+    parser.add_argument("--workDir",
+                        dest="workDir",
+                        help="Directory for the simulated roots and logs (Default: a temporary directory)")
+
+    parser.add_argument("--keep",
+                        dest="keep",
+                        action="store_true",
+                        help="Keep the simulated roots and logs after the run")
+
+    parser.add_argument("--output",
+                        dest="output",
+                        help="Write the results as JSON to this file")
+
+    parser.add_argument("--compare",
+                        dest="compare",
+                        help="Report deltas against the results of an earlier --output")
+
+    args = parser.parse_args()
+
+    latencies = dict(DEFAULT_LATENCIES)
+    latencies.update(parse_knobs(args.latencies, DEFAULT_LATENCIES, "--latency"))
+    latencies = dict((k, v * args.latencyScale) for k, v in latencies.items())
+    failures = parse_knobs(args.failureRates, FAILURE_KEYS, "--failureRate")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    work_dir = args.workDir or mkdtemp(prefix="cyclecloud_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    print("Benchmark work directory: {}".format(work_dir))
+    cert, key = create_certificate(work_dir)
+    base_config = {"latencies": latencies, "failures": failures, "cert": cert, "key": key}
+
+    results = {}
+    try:
+        for name in args.scenarios or SCENARIOS:
+            runs = []
+            for i in range(args.repeat):
+                run = run_scenario(name, args, base_config, path.abspath(args.installer), work_dir, i)
+                if run is not None:
+                    runs.append(run)
+            results[name] = summarize(runs)
+    finally:
+        if not args.keep and not args.workDir:
+            rmtree(work_dir, ignore_errors=True)
+
+    print_report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"created": time(),
+                       "installer": path.abspath(args.installer),
+                       "latencies": latencies,
+                       "failures": failures,
+                       "scenarios": results}, f, indent=2)
+        print("Wrote benchmark results to {}".format(args.output))
+    sys.exit(0 if all(r["status"] == "ok" for r in results.values()) else 1)
+
+
+if __name__ == "__main__":
+    main()